@@ -0,0 +1,295 @@
+"""
+fixed point analyses of a Grammar.
+
+Every term is given an integer index (its position in Grammar.terms()),
+and each analysis is a worklist iteration over those indexes,
+so it costs one pass per change instead of one traversal per question.
+
+* nullable - the term can succeed without consuming input
+* FIRST - the characters a non-empty match of the term can start with
+* FOLLOW - the characters which can come after a match of the term, EOF for the end of input
+* left recursion - rules which can reach themselves without consuming input
+* reachability - rules which can be reached from a rule
+
+Character sets are CharSets, see charset.py.
+Lookaheads don't consume input, so they add nothing to FIRST
+but make the term nullable, which makes FIRST a conservative overestimate.
+"""
+from functools import cached_property
+
+from charset import ANY, EMPTY, EOF, CharSet
+from grammar import Grammar, T, nullable_term, term
+
+
+class Analysis:
+    def __init__(self, g: Grammar, start: str | None = None):
+        self.terms = g.terms()
+        self.ids = {id(t): i for i, t in enumerate(self.terms)}
+        self.names = {self.ids[id(v)]: k for k, v in reversed(g.items()) if id(v) in self.ids}
+        self.children = tuple(
+            tuple(self.ids[id(x)] for x in t[1:] if isinstance(x, list))
+            for t in self.terms
+        )
+        parents: list[list[int]] = [[] for _ in self.terms]
+        for i, kids in enumerate(self.children):
+            for k in kids:
+                parents[k].append(i)
+        self.parents = tuple(map(tuple, parents))
+
+        self._nullable = self._fix_nullable()
+        self._roots = [i for i, p in enumerate(self.parents) if not p]
+        if start is not None:
+            self._roots.append(self.ids[id(g[start])])
+        self._rules = [(k, self.ids[id(v)]) for k, v in g.items() if id(v) in self.ids]
+        self._reach: dict[str, frozenset[str]] = {}
+
+    # everything but nullable is computed on first use,
+    # since most passes over a grammar only need one or two of them.
+    @cached_property
+    def _first(self) -> list[CharSet]:
+        return self._fix_first()
+
+    @cached_property
+    def _follow(self) -> list[CharSet]:
+        return self._fix_follow(self._roots)
+
+    @cached_property
+    def cycles(self) -> list[frozenset[str]]:
+        return self._cycles()
+
+    @cached_property
+    def left_recursive(self) -> frozenset[str]:
+        return frozenset(k for c in self.cycles for k in c)
+
+    @cached_property
+    def _calls(self) -> dict[str, frozenset[str]]:
+        return {k: frozenset(self._calls_from(i)) for k, i in self._rules}
+
+    @cached_property
+    def _callers(self) -> dict[str, set[str]]:
+        out: dict[str, set[str]] = {}
+        for k, calls in self._calls.items():
+            for c in calls:
+                out.setdefault(c, set()).add(k)
+        return out
+
+    # queries
+    def nullable(self, t: term) -> bool:
+        return self._nullable[self.ids[id(t)]]
+
+    def first(self, t: term) -> CharSet:
+        return self._first[self.ids[id(t)]]
+
+    def follow(self, t: term) -> CharSet:
+        return self._follow[self.ids[id(t)]]
+
+    def reachable(self, key: str) -> frozenset[str]:
+        """the rules which can be reached from the rule key, including itself."""
+        if key not in self._reach:
+            seen = {key}
+            todo = [key]
+            while todo:
+                for k in self._calls.get(todo.pop(), ()):
+                    if k not in seen:
+                        seen.add(k)
+                        todo.append(k)
+            self._reach[key] = frozenset(seen)
+        return self._reach[key]
+
+    def dependents(self, keys) -> frozenset[str]:
+        """the given rules and every rule which can reach one of them."""
+        seen = set(keys)
+        todo = list(seen)
+        while todo:
+            for k in self._callers.get(todo.pop(), ()):
+                if k not in seen:
+                    seen.add(k)
+                    todo.append(k)
+        return frozenset(seen)
+
+    def recursive(self, key: str) -> bool:
+        """true if the rule key can reach itself."""
+        return any(key in self.reachable(k) for k in self._calls.get(key, ()))
+
+    # fixpoints
+    def _fix_nullable(self) -> list[bool]:
+        out = [False] * len(self.terms)
+        # terms are in post order, so pop children before their parents
+        todo = list(reversed(range(len(self.terms))))
+        while todo:
+            i = todo.pop()
+            if out[i]:
+                continue
+            n = nullable_term(self.terms[i], (out[k] for k in self.children[i]))
+            if n:
+                # nullable only ever goes from False to True
+                out[i] = True
+                todo.extend(self.parents[i])
+        return out
+
+    def _fix_first(self) -> list[CharSet]:
+        out = [EMPTY] * len(self.terms)
+        todo = list(reversed(range(len(self.terms))))
+        # a term already waiting in todo will see the change anyway
+        pending = bytearray(b'\x01') * len(self.terms)
+        while todo:
+            i = todo.pop()
+            pending[i] = 0
+            match self.terms[i]:
+                case [T.lit, s]:
+                    f = CharSet.of(s[0]) if s else EMPTY
+                case [T.char, *spec]:
+                    f = CharSet.from_spec(spec)
+                case [T.ichar, *spec]:
+                    f = ~CharSet.from_spec(spec)
+                case [T.dot | T.re, *_]:
+                    f = ANY
+                case [T.no | T.yes, *_]:
+                    f = EMPTY
+                case [T.seq, *_]:
+                    f = EMPTY
+                    for k in self.children[i]:
+                        f = f | out[k]
+                        if not self._nullable[k]:
+                            break
+                case _:
+                    f = EMPTY
+                    for k in self.children[i]:
+                        f = f | out[k]
+            if f != out[i]:
+                # sets only grow, so this terminates
+                out[i] = f
+                for p in self.parents[i]:
+                    if not pending[p]:
+                        pending[p] = 1
+                        todo.append(p)
+        return out
+
+    def _fix_follow(self, roots: list[int]) -> list[CharSet]:
+        out = [EMPTY] * len(self.terms)
+        for i in roots:
+            out[i] = CharSet.of(EOF)
+        # and parents before their children
+        todo = list(range(len(self.terms)))
+        pending = bytearray(b'\x01') * len(self.terms)
+        while todo:
+            i = todo.pop()
+            pending[i] = 0
+            kids = self.children[i]
+            match self.terms[i]:
+                case [T.seq, *_]:
+                    # each child is followed by what can start the rest of the sequence
+                    after = out[i]
+                    adds = []
+                    for k in reversed(kids):
+                        adds.append((k, after))
+                        after = self._first[k] | after if self._nullable[k] else self._first[k]
+                case [T.zed | T.one, _]:
+                    adds = [(kids[0], self._first[kids[0]] | out[i])]
+                case [T.no | T.yes, _]:
+                    # whatever the lookahead matched is discarded
+                    adds = [(kids[0], ANY | CharSet.of(EOF))]
+                case _:
+                    adds = [(k, out[i]) for k in kids]
+            for k, f in adds:
+                new = out[k] | f
+                if new != out[k]:
+                    out[k] = new
+                    if not pending[k]:
+                        pending[k] = 1
+                        todo.append(k)
+        return out
+
+    def _cycles(self) -> list[frozenset[str]]:
+        """strongly connected components of the leftmost-call graph which contain a rule."""
+        left: list[tuple[int, ...]] = []
+        for i, t in enumerate(self.terms):
+            kids = self.children[i]
+            if t[0] == T.seq:
+                edges = []
+                for k in kids:
+                    edges.append(k)
+                    if not self._nullable[k]:
+                        break
+                kids = tuple(edges)
+            left.append(kids)
+
+        # iterative tarjan
+        index: dict[int, int] = {}
+        low: dict[int, int] = {}
+        stack: list[int] = []
+        on: set[int] = set()
+        out = []
+        for root in range(len(self.terms)):
+            if root in index:
+                continue
+            work = [(root, 0)]
+            while work:
+                v, pos = work.pop()
+                if pos == 0:
+                    index[v] = low[v] = len(index)
+                    stack.append(v)
+                    on.add(v)
+                if pos < len(left[v]):
+                    work.append((v, pos + 1))
+                    w = left[v][pos]
+                    if w not in index:
+                        work.append((w, 0))
+                    elif w in on:
+                        low[v] = min(low[v], index[w])
+                    continue
+                for w in left[v]:
+                    if w in on:
+                        low[v] = min(low[v], low[w])
+                if low[v] == index[v]:
+                    scc = []
+                    while True:
+                        w = stack.pop()
+                        on.discard(w)
+                        scc.append(w)
+                        if w == v:
+                            break
+                    if len(scc) > 1 or v in left[v]:
+                        out.append(frozenset(self.names[w] for w in scc if w in self.names))
+        return out
+
+    def _calls_from(self, i: int):
+        """the rules referenced from the body of the rule at index i."""
+        seen = {i}
+        todo = list(self.children[i])
+        while todo:
+            k = todo.pop()
+            if k in self.names:
+                yield self.names[k]
+            elif k not in seen:
+                seen.add(k)
+                todo.extend(self.children[k])
+
+
+def test_meta():
+    g = Grammar.meta()
+    a = g.analysis
+    assert a.nullable(g['sp']) and a.nullable(g['grammar'])
+    assert not a.nullable(g['identifier']) and not a.nullable(g['definition'])
+    assert a.first(g['EOL']) == CharSet.of('\r', '\n')
+    assert a.first(g['definition']) == a.first(g['identifier'])
+    assert EOF in a.follow(g['grammar']) and '<' in a.follow(g['identifier'])
+    assert not a.left_recursive
+    assert a.reachable('grammar') == frozenset(g)
+    assert a.reachable('EOL') == {'EOL'}
+
+
+def test_left_recursion():
+    from grammar import first, lit, seq, opt
+    g = Grammar()
+    g['a'] = first(seq(g['b'], lit('x')), lit('y'))
+    g['b'] = seq(opt(lit('z')), g['a'])
+    g['c'] = seq(lit('('), g['c'], lit(')'))
+    a = g.analysis
+    assert a.cycles == [frozenset('ab')]
+    assert a.left_recursive == {'a', 'b'}
+
+
+if __name__ == "__main__":
+    import pytest
+    pytest.main([__file__])
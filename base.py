@@ -32,7 +32,10 @@ except Thing as e:
 * typing.NamedTuple
 """
 
-from typing import  Generator, Iterable, NamedTuple, Protocol, runtime_checkable
+from array import array
+from bisect import bisect_right
+from itertools import accumulate
+from typing import  Callable, Generator, Iterable, NamedTuple, Protocol, runtime_checkable
 
 class ParseError(SyntaxError):
     """raised if a parser fails on input."""
@@ -68,26 +71,132 @@ class match(NamedTuple):
     label:str = ''
     content:'tuple[match,...]' = ()
     def labelled(self) -> 'Generator[match]':
-        if self.label:
-            content = []
-            for c in self.content:
-                content.extend(c.labelled())
-            yield self._replace(content=tuple(content))
-        else:
-            for c in self.content:
-                yield from c.labelled()
+        """the outermost labelled matches, with only labelled matches left in their content."""
+        yield from self._fold(lambda m, content: m._replace(content=tuple(content)))
     def ast(self, src:str) -> Generator[ast]:
-        if self.label:
-            content: list[ast] = []
-            for c in self.content:
-                content.extend(c.ast(src))
+        def node(m, content):
             if content:
-                yield self.label, *content  # type: ignore[misc]
+                return m.label, *content
+            return m.label, src[m.start:m.stop]
+        yield from self._fold(node)
+    def flat(self, kinds:Iterable[str] = ()) -> 'flatast':
+        """
+        the ast as parallel arrays in postorder, see flatast.
+
+        kind ids are positions in kinds, and labels which aren't there are appended in order of appearance.
+        """
+        names = list(kinds)
+        ids = {k:i for i, k in enumerate(names)}
+        out = flatast(names, array('I'), array('L'), array('L'), array('I'))
+        def node(m, content):
+            if (k := ids.get(m.label)) is None:
+                k = ids[m.label] = len(names)
+                names.append(m.label)
+            out.kind.append(k)
+            out.start.append(m.start)
+            out.stop.append(m.stop)
+            out.count.append(len(content))
+        self._fold(node)
+        return out
+    def _fold(self, node:Callable[['match', list], object]) -> list:
+        """
+        node(m, content) for each labelled match in postorder, where content holds
+        the results for the outermost labelled matches inside m.
+        returns the results for the outermost labelled matches.
+
+        The tree is walked once with an explicit stack, so depth isn't limited by recursion,
+        and unlabelled matches add their results straight to the content of their labelled ancestor.
+        """
+        out:list = []
+        # (match, its remaining children, where its result goes, where its children's results go)
+        stack = [(self, iter(self.content), out, [] if self.label else out)]
+        while stack:
+            m, kids, dest, content = stack[-1]
+            for c in kids:
+                if c.content:
+                    stack.append((c, iter(c.content), content, [] if c.label else content))
+                    break
+                if c.label:
+                    content.append(node(c, []))
+            else:
+                stack.pop()
+                if m.label:
+                    dest.append(node(m, content))
+        return out
+
+class flatast(NamedTuple):
+    """
+    an ast as parallel arrays in postorder, one entry per labelled match.
+
+    A node with count 0 is a leaf, whose value is src[start:stop],
+    otherwise its children are the count subtrees just before it.
+    """
+    kinds:list[str]
+    kind:array
+    start:array
+    stop:array
+    count:array
+    def ast(self, src:str) -> list[ast]:
+        """rebuild the nested ast tuples."""
+        stack:list[ast] = []
+        for k, start, stop, n in zip(self.kind, self.start, self.stop, self.count):
+            if n:
+                node = (self.kinds[k], *stack[len(stack)-n:])
+                del stack[len(stack)-n:]
             else:
-                yield self.label, src[self.start:self.stop]
-        else:
-            for c in self.content:
-                yield from c.ast(src)
+                node = (self.kinds[k], src[start:stop])
+            stack.append(node)
+        return stack
+
+def _starts(text:str, base:int = 0) -> Iterable[int]:
+    """base, then base plus the offset just after each newline in text."""
+    # split and len run at C speed, rather than a find() per line
+    return accumulate((len(l) + 1 for l in text.split('\n')[:-1]), initial=base)
+
+class SourceMap:
+    """
+    line and column lookup for a text, built once per input.
+
+    The offset where each line starts is kept in a sorted array,
+    so a lookup is a bisect rather than counting newlines from the start of the text.
+    edit() keeps it in step with the text, only rescanning the inserted text.
+    Lines and columns count from 1, like SyntaxError.
+    """
+    def __init__(self, text:str):
+        self.text = text
+        self.starts = array('L', _starts(text))
+    def __len__(self) -> int:
+        """the number of lines."""
+        return len(self.starts)
+    def pos(self, idx:int) -> tuple[int, int]:
+        """(line, column) of offset idx."""
+        i = bisect_right(self.starts, idx) - 1
+        return i + 1, idx - self.starts[i] + 1
+    def offset(self, lineno:int, col:int = 1) -> int:
+        """the inverse of pos()."""
+        return self.starts[lineno - 1] + col - 1
+    def line(self, lineno:int) -> str:
+        """the text of a line, without its newline."""
+        start = self.starts[lineno - 1]
+        stop = self.starts[lineno] - 1 if lineno < len(self.starts) else len(self.text)
+        return self.text[start:stop]
+    def edit(self, start:int, stop:int, new:str):
+        """replace text[start:stop] with new."""
+        # lines which started inside the old text are gone, the ones after it move
+        lo = bisect_right(self.starts, start)
+        hi = bisect_right(self.starts, stop)
+        delta = len(new) - (stop - start)
+        added = iter(_starts(new, start))
+        next(added)  # start itself, which is inside a line we keep
+        tail = self.starts[hi:]
+        del self.starts[lo:]
+        self.starts.extend(added)
+        self.starts.extend(map(delta.__add__, tail))
+        self.text = self.text[:start] + new + self.text[stop:]
+    def error(self, msg:str, start:int, stop:int|None = None, filename:str|None = None) -> ParseError:
+        """a ParseError for text[start:stop], with the details SyntaxError expects."""
+        stop = start if stop is None else stop
+        return ParseError(msg, (filename, *self.pos(start), self.text, *self.pos(stop)))
 
 # TODO extract generic fmtTree
 def fmtMatch(src, n:match, *, prefix:str='', next_p=''):
@@ -178,3 +287,57 @@ class Driver(Protocol):
     def output(self, text):
         print(text)
 
+
+
+def test_ast():
+    src = 'a+bc'
+    m = match(0, 4, content=(
+        match(0, 1, 'id'),
+        match(1, 2),
+        match(2, 4, 'add', (match(2, 3, 'id'), match(3, 4, content=(match(3, 4, 'id'),)))),
+    ))
+    assert list(m.ast(src)) == [('id', 'a'), ('add', ('id', 'b'), ('id', 'c'))]
+    assert [x.label for x in m.labelled()] == ['id', 'add']
+    assert list(m.labelled())[1].content == (match(2, 3, 'id'), match(3, 4, 'id'))
+    f = m.flat(['add'])
+    assert f.kinds == ['add', 'id'] and list(f.kind) == [1, 1, 1, 0]
+    assert list(f.count) == [0, 0, 0, 2] and list(f.stop) == [1, 3, 4, 4]
+    assert f.ast(src) == list(m.ast(src))
+
+
+def test_depth():
+    """deep trees don't recurse in python."""
+    depth = 100000
+    m = match(0, 1, 'x')
+    for _ in range(depth):
+        m = match(0, 1, 'x', (match(0, 1, content=(m,)),))
+    a, = m.ast('x')
+    for _ in range(depth):
+        a = a[1]
+    assert a == ('x', 'x')
+    assert len(m.flat().kind) == depth + 1
+
+
+def test_source_map():
+    import random
+    text = 'ab\ncd\n\nefg\n'
+    src = SourceMap(text)
+    assert len(src) == 5 and src.line(2) == 'cd' and src.line(3) == '' and src.line(5) == ''
+    for idx in range(len(text) + 1):
+        lineno, col = src.pos(idx)
+        assert lineno == 1 + text.count('\n', 0, idx)
+        assert col == idx - text.rfind('\n', 0, idx)
+        assert src.offset(lineno, col) == idx
+    rng = random.Random(0)
+    for _ in range(200):
+        start = rng.randrange(len(src.text) + 1)
+        stop = rng.randrange(start, len(src.text) + 1)
+        src.edit(start, stop, ''.join(rng.choice('x\n') for _ in range(rng.randrange(4))))
+        assert src.starts == SourceMap(src.text).starts
+    e = SourceMap(text).error('oops', 4, 8)
+    assert (e.lineno, e.offset, e.end_lineno, e.end_offset) == (2, 2, 4, 2)
+
+
+if __name__ == "__main__":
+    import pytest
+    pytest.main([__file__])
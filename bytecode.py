@@ -1,7 +1,15 @@
 from base import *
+from collections import Counter
+from functools import cache
 from typing import Any, Callable
 import struct
 
+# every format is parsed once, and shared by all opcodes and stack operations that use it
+codec = cache(struct.Struct)
+
+# native formats which get a typed view of the stack, see ByteVM.push
+VIEWS = 'bBhHiIlLqQfd'
+
 class opcode:
     """
     A descriptor to wrap opcode definitions.
@@ -9,17 +17,31 @@ class opcode:
     `code` is a unique byte that identifies the compiled opcode
     `func` is a function that implements the opcode
     `argfmt` is a string that follows the struct convention for unpacking arguments to that function.
+    `fuses` names the pair of opcodes this one does the work of, if it's a superinstruction.
+        It takes the args of the first followed by the args of the second.
+
+    These describe the opcode to ByteVM.verify():
+    `effect` is (popped, pushed), struct formats with one character per value on the stack.
+    `branch` is the index of the arg that holds the address the opcode may jump to.
+    `stops` means execution never continues with the next instruction, like an unconditional jump.
+
+    These describe it to ByteVM.peephole():
+    `pure` means it only pops and pushes its effect, computed from its args and what it popped.
+    `store` and `load` are the local variable it writes or reads, if it's always the same one.
 
     """
-    def __new__(cls, code:bytes|str|int, argfmt='', func:Callable|None=None):
+    def __new__(cls, code:bytes|str|int, argfmt='', func:Callable|None=None, **kw):
         # This is a bit of python magic
         if func is None:
-            return lambda f:opcode(code, argfmt, f)
+            return lambda f:opcode(code, argfmt, f, **kw)
         o = object.__new__(cls)
-        o.__init__(code, argfmt, func)
+        o.__init__(code, argfmt, func, **kw)
         return o
 
-    def __init__(self, code:bytes|str|int, argfmt:str='', func:Callable|None=None):
+    def __init__(self, code:bytes|str|int, argfmt:str='', func:Callable|None=None, *,
+                 fuses:tuple[str, str]|None=None,
+                 effect:tuple[str, str]|None=None, branch:int|None=None, stops:bool=False,
+                 pure:bool=False, store:int|None=None, load:int|None=None):
         # normalize code to be bytes of length 1
         match code:
             case str():
@@ -34,7 +56,17 @@ class opcode:
         self.code = code
         self.func = func
         self.argfmt = argfmt
-        self.size = 1 + struct.calcsize(self.argfmt)
+        self.struct = codec(argfmt)
+        self.size = 1 + self.struct.size
+        self.fuses = fuses
+        self.effect = effect
+        # the effect in bytes
+        self.pops, self.pushes = (sum(codec(c).size for c in fmt) for fmt in effect or ('', ''))
+        self.branch = branch
+        self.stops = stops
+        self.pure = pure
+        self.store = store
+        self.load = load
 
     def __str__(self):
         return self.func.__name__
@@ -47,7 +79,7 @@ class opcode:
     def unpack_from(self, buffer, offset=0):
         #if (b:=buffer[offset:offset+1]) != self.code:
         #    raise EvalError(f'Tried to unpack instruction {self.code}:{self} but found {b}.')
-        return (self, *struct.unpack_from(self.argfmt, buffer, offset+1))
+        return (self, *self.struct.unpack_from(buffer, offset+1))
 
 
 class ByteVM(Evaluator):
@@ -76,6 +108,11 @@ class ByteVM(Evaluator):
         self.SP = 0  # stack pointer
         # the stack is a mutable array of bytes
         self.stack = bytearray(self.STACK_LIMIT)
+        # the stack cast to each native type in VIEWS whose size divides STACK_LIMIT,
+        # so an aligned push or pop of that type is a single indexed store or load
+        mem = memoryview(self.stack)
+        self.views = {fmt:mem.cast(fmt) for fmt in VIEWS if not len(mem) % codec(fmt).size}
+        self.codecs:dict[str, tuple[struct.Struct, int, memoryview|None]] = {}
         # code segment is a mutable array of bytes. compile ast if given.
         #self.code = bytearray(b'' if ast is None else self.compile(ast))
         self.code = self.compile(ast)
@@ -87,6 +124,17 @@ class ByteVM(Evaluator):
         self.__opcodes = {bytes(func)[0]:func for func in funcs}
         if len(funcs) != len(self.__opcodes):
             raise CompileError('duplicate byte codes detected')
+        # (code, table) from the last decode, see run()
+        self.__decoded:tuple[bytes, list]|None = None
+        # the code verify() last accepted
+        self.__verified:bytes|None = None
+        # superinstructions by the pair of opcodes they do the work of
+        self.fused:dict[tuple[opcode, opcode], opcode] = {
+            (getattr(self, op.fuses[0]), getattr(self, op.fuses[1])):op
+            for op in funcs if op.fuses
+        }
+        # when set, run() counts how often each pair of opcodes runs one after the other
+        self.counts:Counter[tuple[opcode, opcode]]|None = None
 
 
 
@@ -98,8 +146,11 @@ class ByteVM(Evaluator):
         self.IP = 0
         self.SP = 0
 
-        while self.IP < len(self.code):
-            self.step()
+        if vis is None:
+            self.run()
+        else:
+            while self.IP < len(self.code):
+                self.step()
 
         if self.SP:
             return self.peek()
@@ -137,33 +188,327 @@ class ByteVM(Evaluator):
         self.IP += op.size
         op(self, *args)
 
+    def run(self):
+        """
+        process instructions until IP leaves the code segment.
+
+        This does the same as calling step() in a loop, but each instruction is decoded once,
+        into (bound function, args, next IP) at its address in a table the size of the code.
+        Jumps set IP to an address, so they index the table directly.
+
+        Code which passed verify() runs from the start with push, pop and peek unchecked.
+        """
+        if self.__decoded is None or self.__decoded[0] != self.code:
+            self.__decoded = (bytes(self.code), self.decode())
+        table = self.__decoded[1]
+        if self.counts is not None:
+            return self._profile(table)
+        if self.IP == 0 and self.SP == 0 and self.__verified == self.code:
+            self.push, self.pop, self.peek = self._push, self._pop, self._peek
+            try:
+                return self._run(table)
+            finally:
+                del self.push, self.pop, self.peek
+        self._run(table)
+
+    def _run(self, table:list):
+        end = len(table)
+        IP = self.IP
+        while IP < end:
+            # an address the linear decode didn't reach, like one after data or inside an instruction
+            func, args, nxt = table[IP] or self._decode_at(table, IP)
+            self.IP = nxt
+            func(*args)
+            IP = self.IP
+
+    def _profile(self, table:list):
+        """run(), counting each pair of opcodes where the second follows the first without a jump."""
+        counts = self.counts
+        prev = None
+        IP = self.IP
+        while IP < len(table):
+            func, args, nxt = table[IP] or self._decode_at(table, IP)
+            op = self.__opcodes[self.code[IP]]
+            if prev is not None:
+                counts[prev, op] += 1
+            self.IP = nxt
+            func(*args)
+            prev = op if self.IP == nxt else None
+            IP = self.IP
+
+    def decode(self) -> list[tuple[Callable, tuple, int]|None]:
+        """decode instructions from the start of the code, until the end or an unrecognized byte."""
+        table:list = [None] * len(self.code)
+        IP = 0
+        while IP < len(self.code) and self.code[IP] in self.__opcodes:
+            IP = self._decode_at(table, IP)[2]
+        return table
+
+    def _decode_at(self, table:list, IP:int) -> tuple[Callable, tuple, int]:
+        opcode = self.code[IP]
+        if opcode not in self.__opcodes:
+            raise EvalError(f'unrecognized bytecode {opcode}')
+        op, *args = self.__opcodes[opcode].unpack_from(self.code, IP)
+        table[IP] = entry = (op.func.__get__(self), tuple(args), IP + op.size)
+        return entry
+
     # common stack operations
+    def _codec(self, fmt:str) -> tuple[struct.Struct, int, memoryview|None]:
+        """the codec for fmt, its size and its typed view of the stack, if it has one."""
+        if (c := self.codecs.get(fmt)) is None:
+            s = codec(fmt)
+            c = self.codecs[fmt] = (s, s.size, self.views.get(fmt))
+        return c
+
     def push(self, value, fmt='B'):
         """push a value to the stack with bounds checks."""
-        size = struct.calcsize(fmt)
-        if self.SP + size >= self.STACK_LIMIT:
+        s, size, view = self.codecs.get(fmt) or self._codec(fmt)
+        SP = self.SP
+        if SP + size >= self.STACK_LIMIT:
             raise EvalError('stack overflow')
-        struct.pack_into(fmt, self.stack, self.SP, value)
-        self.SP += size
+        try:
+            if view is None or SP % size:
+                s.pack_into(self.stack, SP, value)
+            else:
+                view[SP // size] = value
+        except (struct.error, ValueError, TypeError) as e:
+            # the view and the codec reject a value with different errors
+            raise EvalError(f'{value!r} does not fit {fmt!r}') from e
+        self.SP = SP + size
 
     def peek(self, fmt='B') -> Any:
         """peek a value to the stack with bounds checks."""
-        size = struct.calcsize(fmt)
+        s, size, view = self.codecs.get(fmt) or self._codec(fmt)
         if len(fmt) > 1:
             raise EvalError('pop should only pop a single value')
-        if self.SP < size:
+        SP = self.SP - size
+        if SP < 0:
             raise EvalError('stack empty')
-        return struct.unpack_from(fmt, self.stack, self.SP-size)[0]
+        if view is None or SP % size:
+            return s.unpack_from(self.stack, SP)[0]
+        return view[SP // size]
 
-    def pop(self, fmt='B') -> int:
+    def pop(self, fmt='B') -> Any:
         """pop a value to the stack with bounds checks."""
-        size = struct.calcsize(fmt)
+        s, size, view = self.codecs.get(fmt) or self._codec(fmt)
         if len(fmt) > 1:
             raise EvalError('pop should only pop a single value')
-        if self.SP < size:
+        SP = self.SP - size
+        if SP < 0:
             raise EvalError('stack empty')
-        self.SP -= size
-        return struct.unpack_from(fmt, self.stack, self.SP)[0]
+        self.SP = SP
+        if view is None or SP % size:
+            return s.unpack_from(self.stack, SP)[0]
+        return view[SP // size]
+
+    # the same without bounds checks, for code which passed verify()
+    def _push(self, value, fmt='B'):
+        s, size, view = self.codecs.get(fmt) or self._codec(fmt)
+        SP = self.SP
+        try:
+            if view is None or SP % size:
+                s.pack_into(self.stack, SP, value)
+            else:
+                view[SP // size] = value
+        except (struct.error, ValueError, TypeError) as e:
+            raise EvalError(f'{value!r} does not fit {fmt!r}') from e
+        self.SP = SP + size
+
+    def _peek(self, fmt='B') -> Any:
+        s, size, view = self.codecs.get(fmt) or self._codec(fmt)
+        SP = self.SP - size
+        if view is None or SP % size:
+            return s.unpack_from(self.stack, SP)[0]
+        return view[SP // size]
+
+    def _pop(self, fmt='B') -> Any:
+        s, size, view = self.codecs.get(fmt) or self._codec(fmt)
+        self.SP = SP = self.SP - size
+        if view is None or SP % size:
+            return s.unpack_from(self.stack, SP)[0]
+        return view[SP // size]
+
+    def verify(self) -> int:
+        """
+        check the code ahead of time, and return the most bytes it can have on the stack.
+
+        Starting from IP 0 with an empty stack, every reachable instruction must be
+        a known opcode with a declared effect, must not pop more than is on the stack
+        or push past STACK_LIMIT, and must be reached with the same depth along every path.
+        That's what push, pop and peek check at runtime, so run() can skip them for this code.
+        The effects are trusted, so an opcode which does more than it declares isn't safe.
+        """
+        depth = {0:0}
+        todo = [0]
+        top = 0
+        while todo:
+            IP = todo.pop()
+            if IP >= len(self.code):
+                # the machine halts
+                continue
+            if (b := self.code[IP]) not in self.__opcodes:
+                raise CompileError(f'unrecognized bytecode {b} at {IP}')
+            op, *args = self.__opcodes[b].unpack_from(self.code, IP)
+            if op.effect is None:
+                raise CompileError(f'{op} at {IP} has no declared stack effect')
+            d = depth[IP] - op.pops
+            if d < 0:
+                raise CompileError(f'stack underflow: {op} at {IP} pops {op.pops} of {depth[IP]} bytes')
+            d += op.pushes
+            if d >= self.STACK_LIMIT:
+                raise CompileError(f'stack overflow: {op} at {IP} leaves {d} bytes')
+            top = max(top, d)
+            nxt = [] if op.stops else [IP + op.size]
+            if op.branch is not None:
+                nxt.append(args[op.branch])
+            for n in nxt:
+                if n not in depth:
+                    depth[n] = d
+                    todo.append(n)
+                elif depth[n] != d:
+                    raise CompileError(f'stack depth at {n} is either {depth[n]} or {d} bytes')
+        self.__verified = bytes(self.code)
+        return top
+
+    def peephole(self, code:bytes=...) -> bytes:
+        """
+        fold constants and drop dead stores in code, using the declared effects of the opcodes.
+
+        * a pure instruction whose operands were all pushed by pure instructions which pop nothing
+          is run here once, and it and its operands are replaced by the shortest pure pushes of its result.
+          A result of nothing, like a push followed by a drop, leaves nothing.
+        * a store to a local which is stored again before anything could read it
+          becomes a pure drop of the same value, which may then fold away with whatever pushed it.
+        Nothing is moved across the target of a branch, and branches are moved to where their targets end up.
+        Instructions which fail when run here are left for run() to fail on.
+        """
+        if code is ...:
+            code = self.code
+        # [op, args, the addresses of the original instructions that now start here]
+        ins:list[list] = []
+        IP = 0
+        while IP < len(code):
+            if code[IP] not in self.__opcodes:
+                raise CompileError(f'unrecognized bytecode {code[IP]} at {IP}')
+            op, *args = self.__opcodes[code[IP]].unpack_from(code, IP)
+            ins.append([op, args, [IP]])
+            IP += op.size
+        targets = {x[1][x[0].branch] for x in ins if x[0].branch is not None}
+        pushes = [op for op in self.__opcodes.values() if op.pure and op.effect and not op.effect[0]]
+        drops = {op.effect[0]:op for op in self.__opcodes.values()
+                 if op.pure and op.effect and not op.effect[1] and not op.argfmt}
+
+        def barrier(x) -> bool:
+            """whether nothing can be folded across the start of x."""
+            return any(a in targets for a in x[2])
+
+        changed = True
+        while changed:
+            changed = False
+            i = 0
+            while i < len(ins):
+                op, args, _ = ins[i]
+                if op.store is not None and op.effect and op.effect[0] in drops and self._dead(ins, i, barrier):
+                    ins[i][:2] = drops[op.effect[0]], []
+                    changed = True
+                    continue
+                if not (op.pure and op.pops):
+                    i += 1
+                    continue
+                # the pure pushes which op pops
+                j, size = i, 0
+                while size < op.pops and j and not barrier(ins[j]):
+                    j -= 1
+                    x = ins[j][0]
+                    if not (x.pure and x.effect[1] and not x.effect[0]) or x.branch is not None:
+                        break
+                    size += x.pushes
+                if size != op.pops or (out := self._fold(ins[j:i+1], pushes)) is None:
+                    i += 1
+                    continue
+                origins = [a for x in ins[j:i+1] for a in x[2]]
+                if out:
+                    out[0][2] = origins
+                elif i + 1 < len(ins):
+                    ins[i+1][2][:0] = origins
+                ins[j:i+1] = out
+                changed = True
+                i = j
+
+        addr = {}
+        IP = 0
+        for op, args, origins in ins:
+            for a in origins:
+                addr[a] = IP
+            IP += op.size
+        for a in targets:
+            addr.setdefault(a, IP)
+        out = bytearray()
+        for op, args, _ in ins:
+            if op.branch is not None:
+                args = [*args]
+                args[op.branch] = addr[args[op.branch]]
+            try:
+                out += bytes(op) + op.struct.pack(*args)
+            except struct.error as e:
+                raise CompileError(f'{op} {args} no longer fits: {e}')
+        return bytes(out)
+
+    def _dead(self, ins:list[list], i:int, barrier:Callable) -> bool:
+        """whether the local stored by ins[i] is stored again before anything could read it."""
+        slot = ins[i][0].store
+        for x in ins[i+1:]:
+            op = x[0]
+            if barrier(x) or op.load == slot or op.branch is not None or op.stops:
+                return False
+            if op.store == slot:
+                return True
+            if not (op.pure or op.store is not None or op.load is not None):
+                return False
+        return False
+
+    def _fold(self, ins:list[list], pushes:list[opcode]) -> list[list]|None:
+        """run ins on an empty stack, and return the pure pushes of what they leave, or None."""
+        saved, SP, IP = bytes(self.stack), self.SP, self.IP
+        try:
+            self.SP = 0
+            for op, args, _ in ins:
+                op(self, *args)
+            result = bytes(self.stack[:self.SP])
+            out = []
+            start = 0
+            for fmt in ins[-1][0].effect[1]:
+                size = codec(fmt).size
+                value = result[start:start + size]
+                start += size
+                best = None
+                for p in pushes:
+                    if p.effect[1] != fmt or (best is not None and p.size >= best[0].size):
+                        continue
+                    if p.argfmt:
+                        args = [codec(fmt).unpack(value)[0]]
+                        try:
+                            p.struct.pack(*args)
+                        except struct.error:
+                            continue
+                    else:
+                        args = []
+                    self.SP = 0
+                    try:
+                        p(self, *args)
+                    except Exception:
+                        continue
+                    if bytes(self.stack[:self.SP]) == value:
+                        best = [p, args, []]
+                if best is None:
+                    return None
+                out.append(best)
+            return out
+        except Exception:
+            return None
+        finally:
+            self.stack[:] = saved
+            self.SP, self.IP = SP, IP
 
     def decompile(self, code:bytes=...):
         """return the bytecode as a human readable string."""
@@ -180,39 +525,207 @@ class ByteVM(Evaluator):
         return '\n'.join(f'    {i}' for i in lines)
 
 
+def test_stack():
+    vm = ByteVM()
+    vm.push(7)
+    # unaligned, so this goes through the struct codec
+    vm.push(-2, 'i')
+    vm.push(1.5, 'd')
+    vm.SP = 8
+    vm.push(2**40, 'q')
+    vm.push(-3, 'i')
+    assert bytes(vm.stack[8:20]) == struct.pack('qi', 2**40, -3)
+    assert vm.peek('i') == vm.pop('i') == -3 and vm.pop('q') == 2**40
+    vm.SP = 5
+    assert vm.pop('i') == -2 and vm.pop() == 7
+    try:
+        vm.pop()
+        assert False, 'should be empty'
+    except EvalError:
+        pass
+
+def test_push_overflow():
+    """a value which doesn't fit its format raises EvalError, from the typed view or the codec."""
+    vm = ByteVM()
+    # 'b' always has a view, '<b' never does, and 'i' has one when aligned
+    for fmt, SP in (('b', 0), ('b', 1), ('<b', 0), ('<b', 1), ('i', 0), ('i', 2)):
+        for value in (2**31, -2**31 - 1, 'x'):
+            for push in (vm.push, vm._push):
+                vm.SP = SP
+                try:
+                    push(value, fmt)
+                    assert False, f'should not push {value!r} as {fmt!r}'
+                except EvalError:
+                    pass
+                assert vm.SP == SP
+
+
+def test_odd_stack():
+    class VM(ByteVM):
+        STACK_LIMIT = 100
+    vm = VM()
+    assert 'B' in vm.views and 'i' in vm.views and 'q' not in vm.views
+    vm.push(2**40, 'q')
+    vm.push(-1, 'i')
+    assert vm.pop('i') == -1 and vm.pop('q') == 2**40
+
+
+def test_verify():
+    class VM(ByteVM):
+        STACK_LIMIT = 16
+
+        @opcode(0, effect=('', ''), stops=True)
+        def halt(self):
+            self.IP = len(self.code)
+
+        @opcode(1, 'B', effect=('', 'B'))
+        def push_byte(self, value):
+            self.push(value)
+
+        @opcode(2, 'i', effect=('', 'i'))
+        def push_int(self, value):
+            self.push(value, 'i')
+
+        @opcode(3, effect=('ii', 'i'))
+        def add(self):
+            self.push(self.pop('i') + self.pop('i'), 'i')
+
+        @opcode(4, 'H', effect=('B', ''), branch=0)
+        def jz(self, L):
+            if not self.pop():
+                self.IP = L
+
+        @opcode(5)
+        def nop(self):
+            pass
+
+    vm = VM(b'')
+    code = lambda *ops: b''.join(bytes(op) + op.struct.pack(*args) for op, *args in ops)
+    vm.code = code((vm.push_int, 2), (vm.push_int, -5), (vm.add,))
+    assert vm.verify() == 8
+    vm()
+    assert vm.peek('i') == -3
+    vm.code = code((vm.push_byte, 0), (vm.jz, 8), (vm.push_byte, 5), (vm.halt,), (vm.push_byte, 7), (vm.halt,))
+    assert vm.verify() == 1 and vm() == 7
+    bad = [
+        # the branch skips a push, so the paths join with different depths
+        code((vm.push_byte, 0), (vm.push_byte, 0), (vm.jz, 9), (vm.push_byte, 1), (vm.halt,)),
+        code((vm.push_int, 1), (vm.add,)),
+        code(*[(vm.push_int, 1)] * 4),
+        code((vm.push_int, 1)) + b'\x09',
+        code((vm.nop,)),
+    ]
+    for vm.code in bad:
+        try:
+            vm.verify()
+            assert False, f'should not verify {vm.code}'
+        except CompileError:
+            pass
+
+
+def test_peephole():
+    class VM(ByteVM):
+        STACK_LIMIT = 16
+
+        @opcode(0, effect=('', ''), stops=True)
+        def halt(self):
+            self.IP = len(self.code)
+
+        @opcode(1, 'B', effect=('', 'B'), pure=True)
+        def push_byte(self, value):
+            self.push(value)
+
+        @opcode(2, effect=('BB', 'B'), pure=True)
+        def add(self):
+            self.push(self.pop() + self.pop())
+
+        @opcode(3, effect=('B', ''), pure=True)
+        def drop(self):
+            self.pop()
+
+        @opcode(4, 'H', effect=('B', ''), branch=0)
+        def jz(self, L):
+            if not self.pop():
+                self.IP = L
+
+        @opcode(5, effect=('', 'B'), pure=True)
+        def zero(self):
+            self.push(0)
+
+        @opcode(6, effect=('B', ''), store=0)
+        def store(self):
+            self.local = self.pop()
+
+        @opcode(7, effect=('', 'B'), load=0)
+        def load(self):
+            self.push(self.local)
+
+    vm = VM(b'')
+    code = lambda *ops: b''.join(bytes(op) + op.struct.pack(*args) for op, *args in ops)
+    # push_byte 5; push_byte 3; add becomes push_byte 8, and a sum of zero uses the shorter zero
+    assert vm.peephole(code((vm.push_byte, 5), (vm.push_byte, 3), (vm.add,))) == code((vm.push_byte, 8))
+    assert vm.peephole(code((vm.push_byte, 0), (vm.push_byte, 0), (vm.add,))) == code((vm.zero,))
+    # folds repeat, and a push which is dropped goes with the drop
+    assert vm.peephole(code(
+        (vm.push_byte, 1), (vm.push_byte, 2), (vm.add,), (vm.push_byte, 3), (vm.add,), (vm.push_byte, 9), (vm.drop,),
+    )) == code((vm.push_byte, 6))
+    # the first store is dead, so its value is dropped, and then never pushed
+    assert vm.peephole(code(
+        (vm.push_byte, 1), (vm.store,), (vm.push_byte, 2), (vm.store,), (vm.load,),
+    )) == code((vm.push_byte, 2), (vm.store,), (vm.load,))
+    # but not if it's loaded in between
+    kept = code((vm.push_byte, 1), (vm.store,), (vm.load,), (vm.push_byte, 2), (vm.store,))
+    assert vm.peephole(kept) == kept
+    # overflow is left for run() to raise
+    kept = code((vm.push_byte, 200), (vm.push_byte, 100), (vm.add,))
+    assert vm.peephole(kept) == kept
+    # branches are moved, and nothing is folded into their target
+    vm.code = code(
+        (vm.push_byte, 1), (vm.push_byte, 2), (vm.add,), (vm.jz, 13), (vm.push_byte, 5), (vm.halt,),
+        (vm.push_byte, 7), (vm.push_byte, 0), (vm.add,), (vm.halt,),
+    )
+    assert vm.peephole() == code(
+        (vm.push_byte, 3), (vm.jz, 10), (vm.push_byte, 5), (vm.halt,),
+        (vm.push_byte, 7), (vm.push_byte, 0), (vm.add,), (vm.halt,),
+    )
+    before = vm()
+    vm.code = vm.peephole()
+    assert vm() == before == 5
+
+
 if __name__ == "__main__":
     class TestVM(ByteVM):
 
-        @opcode(0)
+        @opcode(0, effect=('B', ''), pure=True)
         def drop(self):
             """drop value from the stack"""
             self.SP -= 1
 
-        @opcode(1, 'B')
+        @opcode(1, 'B', effect=('', 'B'), pure=True)
         def push_byte(self, value):
             """push a byte from instructions to the stack"""
             self.push(value)
 
-        @opcode(2)
+        @opcode(2, effect=('BB', 'B'), pure=True)
         def add(self):
             top = self.pop()
             under = self.pop()
             self.push(top + under)
 
-        @opcode(3)
+        @opcode(3, effect=('BB', 'B'))
         def unsafe_add(self):
             self.SP -= 1
             self.stack[self.SP-1] += self.stack[self.SP]
 
-        @opcode(4)
+        @opcode(4, effect=('B', 'B'))
         def print(self):
             print(self.stack[self.SP-1])
 
-        @opcode('FE')
+        @opcode('FE', effect=('', ''))
         def greeting(self):
             print("It's a new day...")
 
-        @opcode(0xFF)
+        @opcode(0xFF, effect=('', ''))
         def goodbye(self):
             print('bye!')
 
@@ -234,6 +747,9 @@ if __name__ == "__main__":
     vm = TestVM(ast)
     print(f"compiled: {vm.code.hex().upper()}")
     print(f'decompiled:\n{vm.decompile()}')
+    print(f'verified, using at most {vm.verify()} bytes of stack')
+    vm.code = bytearray(vm.peephole())
+    print(f'after peephole:\n{vm.decompile()}')
     print('running:')
     vm()
 
@@ -0,0 +1,169 @@
+"""
+character sets as sorted, merged intervals of code points.
+
+The spec of a char() term is a list of 1-2 character strings, in any order and overlapping.
+CharSet normalizes that, so membership is a table lookup for ASCII
+and a bisect over the interval starts otherwise,
+and large ranges cost two integers instead of one entry per character.
+
+The end of input (EOF) is the code point just past the last character,
+so FOLLOW sets can hold it. Complement is only over characters, so ~ never adds EOF.
+"""
+from bisect import bisect_right
+from typing import Iterable, Iterator
+
+MAX = 0x10FFFF
+# marks the end of input
+EOF = ''
+_EOF = MAX + 1
+
+
+def _point(c: str) -> int:
+    return ord(c) if c else _EOF
+
+
+class CharSet:
+    __slots__ = ('intervals', '_starts', '_ascii')
+
+    def __init__(self, intervals: Iterable[tuple[int, int]] = ()):
+        out: list[tuple[int, int]] = []
+        for lo, hi in sorted(intervals):
+            if lo > hi:
+                continue
+            if out and lo <= out[-1][1] + 1:
+                if hi > out[-1][1]:
+                    out[-1] = (out[-1][0], hi)
+            else:
+                out.append((lo, hi))
+        self.intervals = tuple(out)
+        self._starts = tuple(lo for lo, _ in out)
+        table = bytearray(128)
+        for lo, hi in out:
+            if lo >= 128:
+                break
+            table[lo:min(hi, 127) + 1] = b'\x01' * (min(hi, 127) + 1 - lo)
+        self._ascii = bytes(table)
+
+    @classmethod
+    def of(cls, *chars: str) -> 'CharSet':
+        """the set of the given characters, each a single character or EOF."""
+        return cls((p, p) for p in map(_point, chars))
+
+    @classmethod
+    def from_spec(cls, spec: Iterable[str]) -> 'CharSet':
+        """the set of a char() spec, where 'a' is a character and 'az' a range."""
+        return cls((ord(s[0]), ord(s[-1])) for s in spec)
+
+    def spec(self) -> list[str]:
+        """the shortest char() spec for the characters in this set."""
+        out = []
+        for lo, hi in self.intervals:
+            hi = min(hi, MAX)
+            if lo > hi:
+                continue
+            out.append(chr(lo) if lo == hi else chr(lo) + chr(hi))
+        return out
+
+    def __contains__(self, c: str) -> bool:
+        p = _point(c)
+        if p < 128:
+            return self._ascii[p] == 1
+        i = bisect_right(self._starts, p) - 1
+        return i >= 0 and p <= self.intervals[i][1]
+
+    def __iter__(self) -> Iterator[str]:
+        for lo, hi in self.intervals:
+            for p in range(lo, hi + 1):
+                yield EOF if p == _EOF else chr(p)
+
+    def __len__(self) -> int:
+        return sum(hi - lo + 1 for lo, hi in self.intervals)
+
+    def __bool__(self) -> bool:
+        return bool(self.intervals)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, CharSet):
+            return NotImplemented
+        return self.intervals == other.intervals
+
+    def __hash__(self) -> int:
+        return hash(self.intervals)
+
+    def __repr__(self) -> str:
+        return f'CharSet({self.intervals!r})'
+
+    # set algebra
+    def __or__(self, other: 'CharSet') -> 'CharSet':
+        # the fixpoints in analysis.py mostly union a set with an empty or equal one
+        if not other.intervals or self.intervals == other.intervals:
+            return self
+        if not self.intervals:
+            return other
+        return CharSet(self.intervals + other.intervals)
+
+    def __and__(self, other: 'CharSet') -> 'CharSet':
+        out = []
+        a, b = self.intervals, other.intervals
+        i = j = 0
+        while i < len(a) and j < len(b):
+            lo, hi = max(a[i][0], b[j][0]), min(a[i][1], b[j][1])
+            if lo <= hi:
+                out.append((lo, hi))
+            if a[i][1] < b[j][1]:
+                i += 1
+            else:
+                j += 1
+        return CharSet(out)
+
+    def __sub__(self, other: 'CharSet') -> 'CharSet':
+        return self & other._complement(_EOF)
+
+    def __invert__(self) -> 'CharSet':
+        return self._complement(MAX)
+
+    def _complement(self, top: int) -> 'CharSet':
+        out = []
+        lo = 0
+        for a, b in self.intervals:
+            if a > top:
+                break
+            out.append((lo, a - 1))
+            lo = b + 1
+        out.append((lo, top))
+        return CharSet(out)
+
+
+EMPTY = CharSet()
+ANY = ~EMPTY
+
+
+def test_normalize():
+    cs = CharSet.from_spec(['az', 'AZ', '_', 'by', '09'])
+    assert cs.spec() == ['09', 'AZ', '_', 'az']
+    assert all(c in cs for c in 'aqzAQZ_059')
+    assert not any(c in cs for c in '-/:{ ') and EOF not in cs
+    assert len(cs) == 63
+
+
+def test_unicode():
+    cs = CharSet.from_spec(['一鿿'])
+    assert '一' in cs and '汉' in cs and '鿿' in cs
+    assert 'a' not in cs and 'ꀀ' not in cs
+    assert len(cs.intervals) == 1
+
+
+def test_algebra():
+    digits = CharSet.from_spec(['09'])
+    xdigits = digits | CharSet.from_spec(['af', 'AF'])
+    assert xdigits & digits == digits
+    assert xdigits - digits == CharSet.from_spec(['af', 'AF'])
+    assert ~~xdigits == xdigits and not (~xdigits & xdigits)
+    assert ~EMPTY == ANY and EOF not in ANY
+    assert EOF in CharSet.of(EOF) | digits
+    assert (ANY | CharSet.of(EOF)) - ANY == CharSet.of(EOF)
+
+
+if __name__ == "__main__":
+    import pytest
+    pytest.main([__file__])
@@ -0,0 +1,243 @@
+"""
+an ast stored as columns, one row per node, instead of one python object per node.
+
+Rows are in preorder, so a subtree is a contiguous run of rows starting at its root.
+Each column is an array:
+* kind - index into the interned kind table
+* start, stop - the span of source the node matched
+* parent, first, next - the parent, first child and next sibling rows, -1 for none
+
+A node without children is a leaf, whose value is src[start:stop], like ('kind', 'text') in an ast.
+Node is a view of a single row, it holds no data of its own,
+so a pass can walk millions of nodes while only the views it keeps are alive.
+"""
+from array import array
+from typing import Iterable, Iterator
+
+from base import ast, match
+
+
+class Tree:
+    def __init__(self, src: str, kinds: Iterable[str] = ()):
+        self.src = src
+        self.kinds: list[str] = []
+        self._kinds: dict[str, int] = {}
+        for k in kinds:
+            self.intern(k)
+        self.kind = array('I')
+        self.start = array('L')
+        self.stop = array('L')
+        self.parent = array('i')
+        self.first = array('i')
+        self.next = array('i')
+
+    @classmethod
+    def from_match(cls, m: match, src: str, kinds: Iterable[str] = ()) -> 'Tree':
+        """the labelled matches of m, like match.ast(), but as columns."""
+        t = cls(src, kinds)
+        last = array('i')  # last child of each row so far
+        root = -1  # last root so far
+        # (match, row of its nearest labelled ancestor)
+        stack = [(m, -1)]
+        while stack:
+            m, p = stack.pop()
+            if m.label:
+                row = t.add(m.label, m.start, m.stop, p)
+                last.append(-1)
+                if p < 0:
+                    if root >= 0:
+                        t.next[root] = row
+                    root = row
+                elif last[p] < 0:
+                    t.first[p] = last[p] = row
+                else:
+                    t.next[last[p]] = last[p] = row
+                p = row
+            stack.extend((c, p) for c in reversed(m.content))
+        return t
+
+    def intern(self, kind: str) -> int:
+        """the id of kind in the kind table."""
+        if (k := self._kinds.get(kind)) is None:
+            k = self._kinds[kind] = len(self.kinds)
+            self.kinds.append(kind)
+        return k
+
+    def add(self, kind: str, start: int, stop: int, parent: int = -1) -> int:
+        """append a row, and return its index. linking it to its siblings is up to the caller."""
+        self.kind.append(self.intern(kind))
+        self.start.append(start)
+        self.stop.append(stop)
+        self.parent.append(parent)
+        self.first.append(-1)
+        self.next.append(-1)
+        return len(self.kind) - 1
+
+    def __len__(self) -> int:
+        return len(self.kind)
+
+    def __getitem__(self, i: int) -> 'Node':
+        if not -len(self) <= i < len(self):
+            raise IndexError(i)
+        return Node(self, i % len(self))
+
+    def __iter__(self) -> Iterator['Node']:
+        """every node in preorder."""
+        return map(Node, [self] * len(self), range(len(self)))
+
+    def roots(self) -> Iterator['Node']:
+        i = 0 if len(self) else -1
+        while i >= 0:
+            yield Node(self, i)
+            i = self.next[i]
+
+    def ast(self) -> list[ast]:
+        """the nested tuples of match.ast()."""
+        return [self._ast(r.i) for r in self.roots()]
+
+    def _end(self, i: int) -> int:
+        """the row just past the subtree at i."""
+        # that's the next sibling of i, or of its nearest ancestor with one
+        while i >= 0 and self.next[i] < 0:
+            i = self.parent[i]
+        return len(self) if i < 0 else self.next[i]
+
+    def _ast(self, i: int) -> ast:
+        # rows are in preorder, so in reverse every child is built before its parent
+        built: dict[int, ast] = {}
+        for j in reversed(range(i, self._end(i))):
+            c = self.first[j]
+            if c < 0:
+                built[j] = (self.kinds[self.kind[j]], self.src[self.start[j]:self.stop[j]])
+                continue
+            args = []
+            while c >= 0:
+                args.append(built.pop(c))
+                c = self.next[c]
+            built[j] = (self.kinds[self.kind[j]], *args)
+        return built[i]
+
+    def numpy(self) -> dict[str, 'numpy.ndarray']:
+        """
+        the columns as numpy arrays which share memory with this tree.
+
+        numpy is only needed for this, and the tree can't grow while the arrays are alive.
+        """
+        import numpy
+        return {
+            name: numpy.frombuffer(col, dtype=col.typecode)
+            for name in ('kind', 'start', 'stop', 'parent', 'first', 'next')
+            for col in (getattr(self, name),)
+        }
+
+
+class Node:
+    """a view of one row of a Tree, which acts like the ast tuple (kind, *args)."""
+    __slots__ = ('tree', 'i')
+
+    def __init__(self, tree: Tree, i: int):
+        self.tree = tree
+        self.i = i
+
+    @property
+    def kind(self) -> str:
+        return self.tree.kinds[self.tree.kind[self.i]]
+
+    @property
+    def start(self) -> int:
+        return self.tree.start[self.i]
+
+    @property
+    def stop(self) -> int:
+        return self.tree.stop[self.i]
+
+    @property
+    def text(self) -> str:
+        return self.tree.src[self.start:self.stop]
+
+    @property
+    def parent(self) -> 'Node | None':
+        p = self.tree.parent[self.i]
+        return None if p < 0 else Node(self.tree, p)
+
+    @property
+    def children(self) -> Iterator['Node']:
+        c = self.tree.first[self.i]
+        while c >= 0:
+            yield Node(self.tree, c)
+            c = self.tree.next[c]
+
+    def __iter__(self) -> Iterator['Node | str']:
+        """the args of the ast tuple, either the children or the text of a leaf."""
+        if self.tree.first[self.i] < 0:
+            return iter((self.text,))
+        return self.children
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __getitem__(self, k: int) -> 'Node | str':
+        return list(self)[k]
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, Node):
+            return NotImplemented
+        return self.tree is other.tree and self.i == other.i
+
+    def __hash__(self) -> int:
+        return hash((id(self.tree), self.i))
+
+    def __repr__(self) -> str:
+        return f'Node({self.kind!r}, {self.start}, {self.stop})'
+
+    def ast(self) -> ast:
+        """the nested tuple for the subtree at this node."""
+        return self.tree._ast(self.i)
+
+
+def test_columns():
+    from grammar import Grammar
+    from packrat import Packrat
+    src = Grammar.meta().peg()
+    m = Packrat().parse(src)
+    t = Tree.from_match(m, src)
+    assert t.ast() == list(m.ast(src))
+    assert len(t) == len(m.flat().kind)
+    assert set(t.kinds) <= Packrat().kinds
+    # the same nodes, in preorder instead of postorder
+    assert sorted(t.start) == sorted(m.flat().start)
+
+
+def test_views():
+    src = 'a+bc'
+    m = match(0, 4, content=(
+        match(0, 1, 'id'),
+        match(1, 2),
+        match(2, 4, 'add', (match(2, 3, 'id'), match(3, 4, content=(match(3, 4, 'id'),)))),
+    ))
+    t = Tree.from_match(m, src, ['add'])
+    assert t.kinds == ['add', 'id'] and list(t.kind) == [1, 0, 1, 1]
+    a, add = t.roots()
+    assert (a.kind, *a) == ('id', 'a') and a.parent is None
+    assert add.kind == 'add' and len(add) == 2 and add.text == 'bc'
+    b, c = add
+    assert b.parent == add and c.text == 'c' and add[1] == c
+    assert add.ast() == ('add', ('id', 'b'), ('id', 'c')) == t.ast()[1]
+    assert b.ast() == ('id', 'b')
+    assert [n.kind for n in t] == ['id', 'add', 'id', 'id']
+
+
+def test_numpy():
+    import pytest
+    np = pytest.importorskip('numpy')
+    t = Tree.from_match(match(0, 2, 'x', (match(0, 1, 'y'), match(1, 2, 'y'))), 'ab')
+    cols = t.numpy()
+    assert list(cols['parent']) == [-1, 0, 0]
+    # shared, not copied
+    t.stop[0] = 7
+    assert cols['stop'][0] == 7
+
+
+if __name__ == "__main__":
+    import pytest
+    pytest.main([__file__])
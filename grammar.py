@@ -2,12 +2,16 @@
 represent PEG in a normalized form, graph reduction engine?
 """
 from collections import defaultdict
+from collections.abc import Mapping
 from functools import cache, cached_property
 from enum import IntEnum, auto
+import json
 import re
 from typing import Iterable
 
 from base2 import ast
+from charset import ANY, CharSet
+from serialize import check_magic, read_varint, varint as _varint
 
 
 class T(IntEnum):
@@ -32,8 +36,6 @@ class T(IntEnum):
     # ref is a reference to a named rule in the grammar.
     ref = auto()
 
-# TODO expand character ranges, deduplicate
-# return [T.char, ''.join({chr(x) for s in spec for x in range(ord(s[0]), ord(s[-1])-1)})]
 
 
 def unescape(s: str) -> str:
@@ -123,17 +125,71 @@ def ref(name):
     return [T.ref, name]
 
 
+def nullable_term(t, kids: Iterable[bool]) -> bool:
+    """
+    whether a term can match without consuming input, given whether each child can.
+
+    Shared by Grammar.nullable, Frozen.nullable and Analysis, which only differ
+    in how they find the children, so kids is consumed lazily and may be a generator.
+    t may be a term or a Pool node, refs are left to the caller.
+    """
+    match t[0]:
+        case T.lit:
+            return not t[1]
+        case T.re:
+            return re.fullmatch(t[1], '') is not None
+        case T.dot | T.char | T.ichar:
+            return False
+        case T.no | T.yes | T.opt | T.zed:
+            return True
+        case T.seq:
+            return all(kids)
+        case T.first:
+            return any(kids)
+        case T.label | T.one:
+            return next(iter(kids))
+        case _:
+            raise ValueError(t)
+
+
+def charset(t) -> CharSet | None:
+    """the characters a single character term matches, or None if it isn't one."""
+    match t:
+        case [T.char, *spec]:
+            return CharSet.from_spec(spec)
+        case [T.ichar, *spec]:
+            return ~CharSet.from_spec(spec)
+        case [T.lit, s] if len(s) == 1:
+            return CharSet.of(s)
+        case [T.dot]:
+            return ANY
+
+
+def charterm(cs: CharSet) -> list:
+    """the shortest term matching a single character in cs."""
+    if cs == ANY:
+        return dot()
+    inv = ~cs
+    if len(inv.intervals) < len(cs.intervals):
+        return ichar(*inv.spec())
+    return char(*cs.spec())
+
+
 type term = list[T | term | str]
 
 
 class Grammar(dict):
     def __getitem__(self, key: str, /) -> list:
         # act like defaultdict(list)
-        return self.setdefault(key, [])
+        if key not in self:
+            self[key] = []
+        return super().__getitem__(key)
 
     def __setitem__(self, key: str, value: list):
         if key not in self:
-            return super().__setitem__(key, value)
+            super().__setitem__(key, value)
+            self.cache_clear()
+            return
         # preserve the id of the current value
         # but swap its contents
         self[key][:] = value
@@ -143,7 +199,7 @@ class Grammar(dict):
         # TODO clear all the caches
         for cache in ['validate', 'terms', 'peg', 'deduplicate']:
             getattr(self, cache).cache_clear()
-        for cached_property in ['parents']:
+        for cached_property in ['parents', 'analysis', '_names']:
             if cached_property in self.__dict__:
                 delattr(self, cached_property)
 
@@ -156,7 +212,83 @@ class Grammar(dict):
         return all(x and (x != x[0]) for x in self.values())
 
     def copy(self):
-        raise NotImplementedError('this is tricky')
+        """
+        a deep copy, O(size of the grammar).
+
+        Terms are mutable and recursion is by identity, so this goes through the immutable form,
+        where it's by name. The rewrites below change this grammar in place.
+        For cheap copies, and versions which share what a rewrite didn't change,
+        keep a Frozen and use Frozen.copy() and Frozen.rewrite().
+        """
+        return self.freeze().thaw()
+
+    def to_bytes(self) -> bytes:
+        """a compact binary form which keeps shared terms shared. see Frozen.to_bytes"""
+        return self.freeze().to_bytes()
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'Grammar':
+        return Frozen.from_bytes(data).thaw()
+
+    def to_json(self, **kwargs) -> str:
+        """the same as to_bytes, but readable."""
+        return self.freeze().to_json(**kwargs)
+
+    @classmethod
+    def from_json(cls, text: str) -> 'Grammar':
+        return Frozen.from_json(text).thaw()
+
+    def freeze(self, pool: 'Pool | None' = None, ids: dict[int, int] | None = None) -> 'Frozen':
+        """
+        an immutable snapshot of this grammar, interned into pool.
+
+        if given, ids is filled with the node of every term by id(term).
+        """
+        pool = Pool() if pool is None else pool
+        names: dict[int, str] = {}
+        for k, v in self.items():
+            names.setdefault(id(v), k)
+        memo: dict[int, int] = {} if ids is None else ids
+        active: set[int] = set()
+
+        def walk(n) -> int:
+            if id(n) in names:
+                return pool(T.ref, names[id(n)])
+            return body(n)
+
+        def body(n) -> int:
+            if id(n) in memo:
+                return memo[id(n)]
+            if id(n) in active:
+                raise ValueError(f'cycle does not pass through a rule: {self.pe(n, shortcircuit=False)}')
+            active.add(id(n))
+            match n:
+                case []:
+                    i = pool()
+                case [T.dot | T.lit | T.char | T.ichar | T.re | T.ref, *_]:
+                    i = pool(*n)
+                case [T.label, name, term]:
+                    i = pool(T.label, name, walk(term))
+                case [t, *terms]:
+                    i = pool(t, *map(walk, terms))
+            active.discard(id(n))
+            memo[id(n)] = i
+            return i
+
+        return Frozen(pool, {
+            k: body(v) if names[id(v)] == k else pool(T.ref, names[id(v)])
+            for k, v in self.items()
+        })
+
+    def diff(self, other: 'Grammar') -> set[str]:
+        """
+        names of the rules which are defined differently in other, including rules only one of them has.
+
+        Rules are compared structurally, so a rule only differs if its own body does.
+        Analysis.dependents() adds the rules which use them.
+        """
+        a = self.freeze()
+        return a.diff(other.freeze(a.pool))
 
     def __hash__(self):
         # give us a fake hash, otherwise we can't use cache because of self
@@ -167,25 +299,25 @@ class Grammar(dict):
     def terms(self, key: str | None = None) -> tuple[term, ...]:
         """produce a post order deduplicated topological sort of terms reachable from a given rule"""
         # useful for generating a pika parser
-        memo = set()
-
-        def dfs(n):
-            if id(n) in memo:
-                return
-            memo.add(id(n))
-            match n:
-                case [T.dot | T.lit | T.char | T.ichar, *_]:
-                    pass
-                case [T.seq | T.first, left, right]:
-                    yield from dfs(left)
-                    yield from dfs(right)
-                case [T.label, _, term] | [T(), term]:
-                    yield from dfs(term)
-            yield n
-        values = self.values() if key is None else (self[key],)
+        # iterative, since a chain of rules can be deeper than the recursion limit,
+        # and every level of yield from costs a frame per term passed up through it.
+        seen = set()
         out = []
-        for v in values:
-            out.extend(dfs(v))
+        for v in (self.values() if key is None else (self[key],)):
+            if id(v) in seen:
+                continue
+            seen.add(id(v))
+            stack = [(v, iter(v[1:]))]
+            while stack:
+                n, kids = stack[-1]
+                for x in kids:
+                    if isinstance(x, list) and id(x) not in seen:
+                        seen.add(id(x))
+                        stack.append((x, iter(x[1:])))
+                        break
+                else:
+                    stack.pop()
+                    out.append(n)
         return tuple(out)
 
     def remove_lr(self, key=None):
@@ -204,15 +336,18 @@ class Grammar(dict):
                 return
             memo.add(id(n))
             match n:
-                case [T.dot | T.lit | T.char | T.ichar, *_]:
+                case [T.dot | T.lit | T.char | T.ichar | T.re, *_]:
                     return
-                case [T.first, left, right]:
-                    return dfs(left) or dfs(right)
-                case [T.seq, left, right]:
-                    if (ret := dfs(left)):
-                        return ret
-                    if self.nullable(left):
-                        return dfs(right)
+                case [T.first, *terms]:
+                    for x in terms:
+                        if (ret := dfs(x)):
+                            return ret
+                case [T.seq, *terms]:
+                    for x in terms:
+                        if (ret := dfs(x)):
+                            return ret
+                        if not self.nullable(x):
+                            return
                 case [T.label, _, term] | [T(), term]:
                     return dfs(term)
                 case _:
@@ -237,27 +372,26 @@ class Grammar(dict):
                         self.pe(problem, min(T), shortcircuit=False)}"
                     raise NotImplementedError(mea_culpa)
 
+    @cached_property
+    def analysis(self):
+        """nullable, FIRST and FOLLOW sets, left recursion and reachability. see analysis.py"""
+        from analysis import Analysis
+        return Analysis(self)
+
     def nullable(self, term) -> bool:
+        if id(term) in self.analysis.ids:
+            return self.analysis.nullable(term)
+        # a term which isn't part of the grammar (yet)
         memo = {}
 
         def dfs(n):
             if id(n) in memo:
                 return memo[id(n)]
-            ret = None
-            memo[id(n)] = ret
-            match n:
-                case [T.dot | T.lit | T.char | T.ichar, *_]:
-                    ret = False
-                case [T.first, left, right]:
-                    ret = dfs(left) or dfs(right)
-                case [T.seq, left, right]:
-                    ret = dfs(left) and dfs(right)
-                case [T.no | T.yes | T.opt | T.zed, term]:
-                    return True
-                case [T.label, _, term] | [T(), term]:
-                    return dfs(term)
-                case _:
-                    raise ValueError(f"dunno boss {self.pe(n)}")
+            memo[id(n)] = None
+            try:
+                ret = nullable_term(n, (dfs(x) for x in n[1:] if isinstance(x, list)))
+            except ValueError:
+                raise ValueError(f"dunno boss {self.pe(n)}")
             memo[id(n)] = ret
             return ret
         return dfs(term)
@@ -269,38 +403,70 @@ class Grammar(dict):
         out = defaultdict(list)
         for n in self.terms():
             match n:
-                case [T.dot | T.lit | T.char | T.ichar, *_]:
+                case [T.dot | T.lit | T.char | T.ichar | T.re, *_]:
                     pass
-                case [T.seq | T.first, left, right]:
-                    out[id(left)].append(n)
-                    out[id(right)].append(n)
+                case [T.seq | T.first, *terms]:
+                    for x in terms:
+                        out[id(x)].append(n)
                 case [T.label, _, term] | [T(), term]:
                     out[id(term)].append(n)
         return out
 
     @cache
     def deduplicate(self):
-        """deduplicate equivalent subclauses"""
-        for i, oldTerm in enumerate(self.terms()):
-            for newTerm in self.terms()[:i]:
-                if oldTerm == newTerm and oldTerm is not newTerm:
-                    # self._replace can be much simpler if we don't use it here
-                    # self._replace(oldTerm, newTerm)
-                    for p in self.parents[id(oldTerm)]:
-                        match p:
-                            case [T.dot | T.lit | T.char | T.ichar, *_]:
-                                raise ValueError(
-                                    'terminal is supposedly a parent')
-                            case [T.seq | T.first, left, right]:
-                                if left == oldTerm:
-                                    p[1] = newTerm
-                                if right == oldTerm:
-                                    p[2] = newTerm
-                            case [T.label, *_]:
-                                p[2] = newTerm
-                            case [T(), _]:
-                                p[1] = newTerm
-                    self.cache_clear()
+        """
+        deduplicate equivalent subclauses
+
+        Terms are hash-consed in one post-order pass, keyed by their type, their
+        string arguments and the identity of their (already canonical) children.
+        A child reached through a cycle isn't canonical yet, so it is keyed by its own id.
+        That can miss a merge of two equal recursive terms, but never merges unequal ones.
+        """
+        canon: dict[int, term] = {}
+        seen: dict[tuple, term] = {}
+        for n in self.terms():
+            key = tuple(id(canon.get(id(x), x)) if isinstance(x, list) else x for x in n)
+            canon[id(n)] = seen.setdefault(key, n)
+        # point every parent at the canonical children, then invalidate caches once
+        changed = False
+        for n in self.terms():
+            for i, x in enumerate(n):
+                if isinstance(x, list) and canon.get(id(x), x) is not x:
+                    n[i] = canon[id(x)]
+                    changed = True
+        if changed:
+            self.cache_clear()
+
+    def inline(self, key=None, limit: int = 4):
+        """
+        splice nested seq and first into their parent.
+
+        seq(a, seq(b, c)) -> seq(a, b, c), and the same for first.
+        Each splice removes a clause, so a memo entry and a call per attempt.
+        The body of a rule is spliced into its users if the rule doesn't recurse
+        and its body has at most `limit` terms, so small rules like EOL aren't a clause of their own.
+        Labels are never spliced through, so the ast is unchanged.
+        """
+        a = self.analysis
+        names = {id(v): k for k, v in reversed(self.items())}
+        changed = False
+        for t in self.terms(key):
+            if t[0] not in (T.seq, T.first):
+                continue
+            kids = []
+            for x in t[1:]:
+                if x[0] == t[0] and x is not t and (
+                    id(x) not in names
+                    or (len(x) - 1 <= limit and not a.recursive(names[id(x)]))
+                ):
+                    kids.extend(x[1:])
+                else:
+                    kids.append(x)
+            if len(kids) != len(t) - 1:
+                t[1:] = kids
+                changed = True
+        if changed:
+            self.cache_clear()
 
     def _getname(self, like: str = '') -> str:
         """get a rule name that hasn't been used yet."""
@@ -330,26 +496,71 @@ class Grammar(dict):
     _ = lit('')
 
     def enable_regex(self, key=None):
-        """graph rewrite operations"""
-        def fmt(t):
-            if t[0] == T.lit:
-                return re.escape(t[1])
-            return self.pe(t)
-
+        """
+        collapse maximal regular subgraphs into a single regex.
+
+        A term is regular if it has no labels and doesn't recurse,
+        so it can be matched without producing any structure.
+        PEG never backtracks into a term once it has matched, so every choice becomes
+        an atomic group and every repetition is possessive.
+        That way each pattern matches exactly the span the term would.
+        """
+        frag, null = self._fragments(key)
+        rules = {id(v) for v in self.values()}
+        todo = [
+            t for t in self.terms(key)
+            if id(t) in frag
+            and t[0] not in (T.dot, T.lit, T.char, T.ichar, T.re)
+            and (id(t) in rules or not all(id(p) in frag for p in self.parents[id(t)]))
+            # a lookahead can succeed without consuming input, but not on empty input.
+            # the pattern has to agree with nullable(), so leave those to the parent.
+            and (re.fullmatch(frag[id(t)], '') is not None) == null[id(t)]
+        ]
+        for t in todo:
+            self._replace(t, regex(frag[id(t)]))
+
+    def pattern(self, t: term) -> str | None:
+        """a regex matching exactly what the term t matches, or None if it isn't regular."""
+        return self._fragments()[0].get(id(t))
+
+    def _fragments(self, key=None) -> tuple[dict[int, str], dict[int, bool]]:
+        """the regex of every regular term by id, and whether it matches the empty string."""
+        frag: dict[int, str] = {}
+        null: dict[int, bool] = {}
+        alts: dict[int, list[str]] = {}
         for t in self.terms(key):
             match t:
-                case [T.seq, [T.lit | T.char | T.ichar, *_], [T.lit | T.char | T.ichar, *_]]:
-                    self._replace(t, regex(f"{fmt(t[1])}{fmt(t[2])}"))
-                case [T.seq, [T.re, pattern], [T.lit | T.char | T.ichar, *_]]:
-                    self._replace(t, regex(f"(?:{pattern}){fmt(t[2])}"))
-                case [T.seq, [T.lit | T.char | T.ichar, *_], [T.re, pattern]]:
-                    self._replace(t, regex(f"{fmt(t[2])}(?:{pattern})"))
-                case [T.first, [T.lit | T.char | T.ichar, *_], [T.lit | T.char | T.ichar, *_]]:
-                    self._replace(t, regex(f"{fmt(t[1])}|{fmt(t[2])}"))
-                case [T.first, [T.re, pattern], [T.lit | T.char | T.ichar, *_]]:
-                    self._replace(t, regex(f"(?:{pattern})|{fmt(t[2])}"))
-                case [T.first, [T.lit | T.char | T.ichar, *_], [T.re, pattern]]:
-                    self._replace(t, regex(f"{fmt(t[2])}|(?:{pattern})"))
+                case [T.dot]:
+                    p, n = '(?s:.)', False
+                case [T.lit, s]:
+                    p, n = re.escape(s), not s
+                case [T.char | T.ichar]:
+                    # re has no empty set, [] and [^] don't compile
+                    p, n = '(?!)' if t[0] == T.char else r'[\s\S]', False
+                case [T.char | T.ichar, *spec]:
+                    inv = '^' if t[0] == T.ichar else ''
+                    spec = ''.join('-'.join(map(re.escape, (x[0], x[-1]))) if len(x) > 1 else re.escape(x) for x in spec)
+                    p, n = f'[{inv}{spec}]', False
+                case [T.re, p]:
+                    # keep precedence when spliced into a larger pattern, and don't backtrack into it
+                    p, n = f'(?>{p})', re.fullmatch(p, '') is not None
+                case [T.seq, *terms] if all(id(x) in frag for x in terms):
+                    p = ''.join(frag[id(x)] for x in terms)
+                    n = all(null[id(x)] for x in terms)
+                case [T.first, *terms] if all(id(x) in frag for x in terms):
+                    # (?>a|(?>b|c)) -> (?>a|b|c)
+                    alts[id(t)] = [a for x in terms for a in alts.get(id(x), [frag[id(x)]])]
+                    p = f"(?>{'|'.join(alts[id(t)])})"
+                    n = any(null[id(x)] for x in terms)
+                case [T.no | T.yes, x] if id(x) in frag:
+                    p, n = f"(?{'!' if t[0] == T.no else '='}{frag[id(x)]})", True
+                case [T.zed | T.one | T.opt, x] if id(x) in frag:
+                    p = f"(?:{frag[id(x)]}){ {T.zed: '*+', T.one: '++', T.opt: '?+'}[t[0]]}"
+                    n = t[0] != T.one or null[id(x)]
+                case _:
+                    continue
+            frag[id(t)], null[id(t)] = p, n
+        return frag, null
 
     def reduce(self, key=None):
         """graph rewrite operations"""
@@ -377,19 +588,18 @@ class Grammar(dict):
                 case [T.seq, [T.lit, a], [T.lit, b]]:
                     # 'a' 'b' -> 'ab'
                     self._replace(t, lit(f"{a}{b}"))
-                case [T.first, [T.lit, a], [T.lit, b]] if len(a) == len(b) == 1:
+                case [T.first, a, b] if (x := charset(a)) is not None and (y := charset(b)) is not None:
                     # 'a' / 'b' -> [ab]
-                    self._replace(t, char(a, b))
-                case [T.first, [T.char, *spec], [T.lit, b]] | \
-                     [T.first, [T.lit, b], [T.char, *spec]] if len(b) == 1:
                     # [a] / 'b' -> [ab]
-                    #  'b' / [a] -> [ab]
-                    self._replace(t, char(*spec, b))
+                    # [^a] / 'a' -> .
+                    self._replace(t, charterm(x | y))
+                case [T.char | T.ichar, *_] if (n := charterm(charset(t))) != t:
+                    # [caab] -> [a-c]
+                    self._replace(t, n)
                 case [T.zed, a]:
                     name = self._getname('REP')
                     self[name] = first(seq(a, self[name]), self._)
                     self._replace(t, self[name])
-                # TODO normalize char spec
                 # TODO (a b) c -> a (b c)
                 # TODO (a / b) / c -> a / (b / c)
 
@@ -410,13 +620,48 @@ class Grammar(dict):
             return '\n'.join(self.peg(k) for k in sorted(self))
         return f"{key} <- {self.pe(super().__getitem__(key), max(T), False)}"
 
+    def __delitem__(self, key: str):
+        super().__delitem__(key)
+        self.cache_clear()
+
+    @cached_property
+    def _names(self) -> tuple[dict[int, term], dict[tuple, term], dict[int, str]]:
+        """
+        index terms to the name of the first rule they are equal to.
+
+        Terms are keyed like in deduplicate(), so equal terms share a representative:
+        (id -> representative, key -> representative, id of representative -> rule name)
+        """
+        canon: dict[int, term] = {}
+        keys: dict[tuple, term] = {}
+        for n in self.terms():
+            key = tuple(id(canon.get(id(x), x)) if isinstance(x, list) else x for x in n)
+            canon[id(n)] = keys.setdefault(key, n)
+        names: dict[int, str] = {}
+        for k, v in self.items():
+            names.setdefault(id(canon[id(v)]), k)
+        return canon, keys, names
+
+    def name(self, expr) -> str | None:
+        """the name of the first rule equal to expr, if any."""
+        canon, keys, names = self._names
+        active = set()
+
+        def rep(n):
+            if (r := canon.get(id(n))) is not None or id(n) in active:
+                return r
+            # not part of the grammar, but it may equal something that is
+            active.add(id(n))
+            return keys.get(tuple(
+                id(x if (r := rep(x)) is None else r) if isinstance(x, list) else x for x in n
+            ))
+        return None if (r := rep(expr)) is None else names.get(id(r))
+
     def pe(self, expr, outerT: T = max(T), shortcircuit=True):
         """format a parsing expression"""
         # TODO this may no longer be possible after eliminating left recursion
-        if shortcircuit:
-            for k, v in self.items():
-                if expr == v:
-                    return k
+        if shortcircuit and (k := self.name(expr)) is not None:
+            return k
         match expr:
             case [T.dot]:
                 out = '.'
@@ -439,10 +684,10 @@ class Grammar(dict):
                 return f"`{repr(pattern)[1:-1]}`"
             case [T.label, name, term]:
                 out = f"{name}:{self.pe(term, T.label)}"
-            case [T.seq, left, right]:
-                out = f"{self.pe(left, T.seq)} {self.pe(right, T.seq)}"
-            case [T.first, left, right]:
-                out = f"{self.pe(left, T.first)} / {self.pe(right, T.first)}"
+            case [T.seq, *terms]:
+                out = ' '.join(self.pe(x, T.seq) for x in terms)
+            case [T.first, *terms]:
+                out = ' / '.join(self.pe(x, T.first) for x in terms)
             case [T.no, term]:
                 out = f"!{self.pe(term, T.no)}"
             case [T.yes, term]:
@@ -550,6 +795,339 @@ class Grammar(dict):
         return g
 
 
+
+class Pool:
+    """
+    interns immutable grammar nodes, so structurally equal terms get the same integer id.
+
+    A node is a tuple (T, *args) where child terms are the ids of other nodes.
+    Recursion goes through (T.ref, name), so the nodes form a DAG.
+    Nodes never change, so analyses of nodes without refs are kept in memo,
+    and shared by every grammar built on this pool.
+    """
+    def __init__(self):
+        self.nodes: list[tuple] = []
+        self.ids: dict[tuple, int] = {}
+        self.memo: dict[tuple[str, int], object] = {}
+
+    def __call__(self, *node) -> int:
+        if (i := self.ids.get(node)) is None:
+            i = self.ids[node] = len(self.nodes)
+            self.nodes.append(node)
+        return i
+
+    def __getitem__(self, i: int) -> tuple:
+        return self.nodes[i]
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def children(self, i: int) -> tuple[int, ...]:
+        match self.nodes[i]:
+            case () | (T.dot | T.lit | T.char | T.ichar | T.re | T.ref, *_):
+                return ()
+            case (T.label, _, term):
+                return (term,)
+            case (_, *terms):
+                return tuple(terms)
+
+    def map(self, i: int, f) -> int:
+        """intern a copy of node i with f applied to the id of each child."""
+        match self.nodes[i]:
+            case () | (T.dot | T.lit | T.char | T.ichar | T.re | T.ref, *_):
+                return i
+            case (T.label, name, term):
+                return self(T.label, name, f(term))
+            case (t, *terms):
+                return self(t, *map(f, terms))
+
+    def closed(self, i: int) -> bool:
+        """true if no ref is reachable from node i."""
+        key = ('closed', i)
+        if key not in self.memo:
+            self.memo[key] = self.nodes[i][:1] != (T.ref,) and all(map(self.closed, self.children(i)))
+        return self.memo[key]
+
+    def refs(self, i: int) -> frozenset[str]:
+        """names of the rules referenced from node i."""
+        key = ('refs', i)
+        if key not in self.memo:
+            match self.nodes[i]:
+                case (T.ref, name):
+                    out = frozenset((name,))
+                case _:
+                    out = frozenset().union(*map(self.refs, self.children(i)))
+            self.memo[key] = out
+        return self.memo[key]
+
+
+class Frozen(Mapping):
+    """
+    an immutable grammar, mapping rule names to node ids in a Pool.
+
+    copy() is free, and set() and replace() make a new version
+    which only interns the nodes that changed.
+    rewrite() does the same for the in-place rewrites of Grammar, though it costs a thaw and a freeze.
+    """
+    def __init__(self, pool: Pool, rules: dict[str, int]):
+        self.pool = pool
+        self._rules = dict(rules)
+        self._nullable: dict[str, bool] | None = None
+
+    def __getitem__(self, key: str) -> int:
+        return self._rules[key]
+
+    def __iter__(self):
+        return iter(self._rules)
+
+    def __len__(self) -> int:
+        return len(self._rules)
+
+    def __hash__(self):
+        return hash(frozenset(self._rules.items()))
+
+    def copy(self) -> 'Frozen':
+        return self
+
+    def set(self, key: str, node: int) -> 'Frozen':
+        return Frozen(self.pool, {**self._rules, key: node})
+
+    def replace(self, old: int, new: int) -> 'Frozen':
+        """a version where every occurrence of node old is node new."""
+        memo = {old: new}
+
+        def walk(i):
+            if i not in memo:
+                memo[i] = self.pool.map(i, walk)
+            return memo[i]
+        return Frozen(self.pool, {k: walk(v) for k, v in self.items()})
+
+    def rewrite(self, method: str, *args, **kwargs) -> 'Frozen':
+        """
+        a new version with a Grammar rewrite applied, like f.rewrite('remove_lr', 'grammar').
+
+        The rewrite runs on a thawed copy, and its result is interned into the same pool,
+        so nodes it didn't change keep their ids, and the analyses the pool has of them.
+        This version is left as it was.
+        """
+        g = self.thaw()
+        getattr(g, method)(*args, **kwargs)
+        return g.freeze(self.pool)
+
+    def diff(self, other: 'Frozen') -> 'set[str]':
+        """like Grammar.diff. both must be in the same pool, where equal nodes have equal ids."""
+        if other.pool is not self.pool:
+            raise ValueError('grammars must share a pool to be compared')
+        return {k for k in self.keys() | other.keys() if self.get(k) != other.get(k)}
+
+    def nullable(self, i: int) -> bool:
+        """like Grammar.nullable, but results for closed nodes are kept in the pool."""
+        if self._nullable is None:
+            # least fixed point over the rules
+            self._nullable = dict.fromkeys(self, False)
+            while True:
+                new = {k: self._null(v, self._nullable, {}) for k, v in self.items()}
+                if new == self._nullable:
+                    break
+                self._nullable = new
+        return self._null(i, self._nullable, {})
+
+    def _null(self, i: int, rules: dict[str, bool], memo: dict[int, bool]) -> bool:
+        key = ('nullable', i)
+        if key in self.pool.memo:
+            return self.pool.memo[key]
+        if i in memo:
+            return memo[i]
+        match self.pool[i]:
+            case (T.ref, name):
+                ret = rules.get(name, False)
+            case node:
+                ret = nullable_term(node, (self._null(x, rules, memo) for x in self.pool.children(i)))
+        memo[i] = ret
+        if self.pool.closed(i):
+            self.pool.memo[key] = ret
+        return ret
+
+    # serialization
+    # binary: MAGIC VERSION strings nodes rules, where every count and index is a LEB128 varint.
+    # nodes are in pool order, so children always come before their parents,
+    # and each argument is a string index * 2, or a node index * 2 + 1.
+    MAGIC = b'TRG'
+    VERSION = 1
+
+    def _reachable(self) -> list[int]:
+        """ids of every node used by a rule, children first."""
+        seen = set(self.values())
+        todo = list(seen)
+        while todo:
+            for k in self.pool.children(todo.pop()):
+                if k not in seen:
+                    seen.add(k)
+                    todo.append(k)
+        return sorted(seen)
+
+    def to_bytes(self) -> bytes:
+        order = self._reachable()
+        index = {i: n for n, i in enumerate(order)}
+        strings: dict[str, int] = {}
+        body = bytearray()
+        _varint(body, len(order))
+        for i in order:
+            kind, *args = self.pool[i] or (0,)
+            _varint(body, kind)
+            _varint(body, len(args))
+            for a in args:
+                if isinstance(a, str):
+                    _varint(body, strings.setdefault(a, len(strings)) * 2)
+                else:
+                    _varint(body, index[a] * 2 + 1)
+        _varint(body, len(self))
+        for k, i in self.items():
+            _varint(body, strings.setdefault(k, len(strings)))
+            _varint(body, index[i])
+        head = bytearray(self.MAGIC)
+        head.append(self.VERSION)
+        _varint(head, len(strings))
+        for x in strings:
+            b = x.encode()
+            _varint(head, len(b))
+            head += b
+        return bytes(head + body)
+
+    @classmethod
+    def from_bytes(cls, data: bytes, pool: Pool | None = None) -> 'Frozen':
+        """raises ValueError if data is truncated or corrupt."""
+        pool = Pool() if pool is None else pool
+        magic = cls.MAGIC + bytes([cls.VERSION])
+        check_magic(data[:len(magic)], magic, 'serialized grammar')
+        pos = len(magic)
+
+        def read() -> int:
+            nonlocal pos
+            n, pos = read_varint(data, pos)
+            return n
+
+        def at(table: list, i: int):
+            if i >= len(table):
+                raise ValueError(f'index {i} out of range in serialized grammar')
+            return table[i]
+
+        strings = []
+        for _ in range(read()):
+            size = read()
+            if pos + size > len(data):
+                raise ValueError('data ended inside a string')
+            strings.append(bytes(data[pos:pos+size]).decode())
+            pos += size
+        nodes: list[int] = []
+        for _ in range(read()):
+            kind = read()
+            args = [at(nodes, a >> 1) if a & 1 else at(strings, a >> 1) for a in (read() for _ in range(read()))]
+            nodes.append(pool(T(kind), *args) if kind else pool())
+        rules = {at(strings, read()): at(nodes, read()) for _ in range(read())}
+        if pos != len(data):
+            raise ValueError('trailing data after serialized grammar')
+        return cls(pool, rules)
+
+    def to_json(self, **kwargs) -> str:
+        order = self._reachable()
+        index = {i: n for n, i in enumerate(order)}
+        nodes = []
+        for i in order:
+            kind, *args = self.pool[i] or (None,)
+            if kind is None:
+                nodes.append([])
+            else:
+                nodes.append([kind.name, *(a if isinstance(a, str) else index[a] for a in args)])
+        return json.dumps({
+            'version': self.VERSION,
+            'nodes': nodes,
+            'rules': {k: index[i] for k, i in self.items()},
+        }, **kwargs)
+
+    @classmethod
+    def from_json(cls, text: str, pool: Pool | None = None) -> 'Frozen':
+        pool = Pool() if pool is None else pool
+        data = json.loads(text)
+        if data.get('version') != cls.VERSION:
+            raise ValueError(f"unsupported grammar version {data.get('version')}")
+        nodes: list[int] = []
+        for kind, *args in (n or [None] for n in data['nodes']):
+            args = [a if isinstance(a, str) else nodes[a] for a in args]
+            nodes.append(pool(T[kind], *args) if kind else pool())
+        return cls(pool, {k: nodes[i] for k, i in data['rules'].items()})
+
+    def thaw(self) -> Grammar:
+        """a mutable Grammar with the same rules. refs become shared rule values again."""
+        g = Grammar()
+        memo: dict[int, list] = {}
+
+        def resolve(k: str) -> str:
+            seen = set()
+            while k in self and (node := self.pool[self[k]])[:1] == (T.ref,):
+                if k in seen:
+                    raise ValueError(f'rule {k} is an alias of itself')
+                seen.add(k)
+                k = node[1]
+            return k
+
+        # make every rule value up front, so rules keep their order
+        values = {k: [] for k in self}
+        for k in self:
+            t = resolve(k)
+            values[k] = values[t] if t in values else g[t]
+            dict.__setitem__(g, k, values[k])
+
+        def build(i: int) -> list:
+            match self.pool[i]:
+                case (T.ref, name):
+                    return g[name]
+            if i not in memo:
+                memo[i] = fresh(i)
+            return memo[i]
+
+        def fresh(i: int) -> list:
+            match node := self.pool[i]:
+                case () | (T.dot | T.lit | T.char | T.ichar | T.re, *_):
+                    return list(node)
+                case (T.label, name, term):
+                    return [T.label, name, build(term)]
+                case (t, *terms):
+                    return [t, *map(build, terms)]
+
+        for k, i in self.items():
+            # an alias shares the value of the rule it names
+            if self.pool[i][:1] != (T.ref,):
+                values[k][:] = fresh(i)
+        return g
+
+
+def test_serialize():
+    g = Grammar.meta()
+    g.reduce('grammar')
+    data = g.to_bytes()
+    assert data.startswith(Frozen.MAGIC)
+    for h in (Grammar.from_bytes(data), Grammar.from_json(g.to_json())):
+        assert h.peg() == g.peg()
+        assert len(h.terms()) == len(g.terms())
+    assert Grammar.from_bytes(data).to_bytes() == data
+    try:
+        Grammar.from_bytes(Frozen.MAGIC + bytes([Frozen.VERSION + 1]) + data[4:])
+        assert False, 'should not load'
+    except ValueError:
+        pass
+    # truncated or corrupt data raises ValueError, not whatever the decoder tripped on
+    corrupt = [data[:n] for n in range(len(data))]
+    corrupt += [data[:n] + b'\xff' + data[n+1:] for n in range(4, len(data), 7)]
+    corrupt.append(data + b'\x00')
+    for bad in corrupt:
+        try:
+            Grammar.from_bytes(bad)
+            assert False, f"should not load {bad!r}"
+        except ValueError:
+            pass
+
+
 def test_lr():
     g = Grammar()
     g['a'] = first(seq(g['a'], lit(' bap')), lit('boom'))
@@ -580,11 +1158,136 @@ def test_reduce():
     print(g)
 
 
+def test_enable_regex():
+    g = Grammar()
+    g['a'] = seq(lit('x'), one(char('09')), label('n', first(lit('y'), lit('z'), lit('w'))), no(dot()))
+    g.enable_regex()
+    assert g.peg() == "a <- 'x' `(?:[0-9])++` n:`(?>y|z|w)` `(?!(?s:.))`"
+    # lookaheads are only collapsed along with something that consumes input
+    g = Grammar()
+    g['a'] = label('a', seq(yes(lit('x')), label('b', dot())))
+    g.enable_regex()
+    assert g.peg() == "a <- a:(&'x' b:.)"
+    # an existing regex keeps its own alternation
+    from packrat import Packrat
+    g = Grammar()
+    g['grammar'] = seq(regex('x|y'), lit('z'))
+    g.enable_regex()
+    assert g.pattern(g['grammar']) == '(?>(?>x|y)z)'
+    assert Packrat(g).parse('yz').stop == 2
+    try:
+        Packrat(g).parse('x')
+        assert False, 'should not parse'
+    except SyntaxError:
+        pass
+    # empty sets match nothing, or any character
+    g = Grammar()
+    g['grammar'] = seq(first(char(), lit('a')), ichar(), lit('z'))
+    g.enable_regex()
+    assert g['grammar'][0] == T.re
+    assert Packrat(g).parse('a\nz').stop == 3
+    for bad in ('\nz', 'az'):
+        try:
+            Packrat(g).parse(bad)
+            assert False, 'should not parse'
+        except SyntaxError:
+            pass
+
+
+def test_inline():
+    g = Grammar.meta()
+    size = len(g.terms('grammar'))
+    g.inline('grammar')
+    assert len(g.terms('grammar')) < size
+    assert g.peg('sp') == "sp <- (' ' / '\\t' / '\\r\\n' / '\\n' / '\\r' / comment)*"
+    # recursive rules stay where they are
+    assert g.peg('E1') == Grammar.meta().peg('E1')
+
+
+def test_reduce_charset():
+    g = Grammar()
+    g['a'] = first(lit('b'), char('ac', 'x'), lit('d'), ichar('a', 'y'))
+    g.reduce()
+    assert g.peg() == "a <- [^y]"
+    g['a'] = first(char('09', '3'), lit('a'), lit('x'))
+    g.reduce()
+    assert g.peg() == "a <- [0-9ax]"
+
+
+def test_name():
+    g = Grammar.meta()
+    assert g.name(g['sp']) == 'sp'
+    # equal to a rule, but not the same list
+    assert g.name(first(lit('\r\n'), lit('\n'), lit('\r'))) == 'EOL'
+    assert g.name(lit('nope')) is None
+    g['spaces'] = g['sp']
+    assert g.name(g['sp']) == 'sp'
+    del g['sp']
+    assert g.name(g['spaces']) == 'spaces'
+
+
 def test_deduplicate():
     g = Grammar.meta()
     oldsize = len(g.terms())
     g.deduplicate()
     assert len(g.terms()) < oldsize
+    assert g.peg() == Grammar.meta().peg()
+    # nothing left to merge
+    size = len(g.terms())
+    g.cache_clear()
+    g.deduplicate()
+    assert len(g.terms()) == size
+
+
+def test_freeze():
+    g = Grammar.meta()
+    f = g.freeze()
+    assert f.thaw().peg() == g.peg()
+    # structurally equal versions are equal
+    assert g.freeze(f.pool) == f
+    # copies don't share terms
+    c = g.copy()
+    c['sp'] = lit(' ')
+    assert c.peg() != g.peg() and g.peg() == Grammar.meta().peg()
+    # rewrites only intern what changed
+    size = len(f.pool)
+    new = f.replace(f.pool(T.lit, '<-'), f.pool(T.lit, '='))
+    assert len(f.pool) - size < 10
+    assert new['sp'] == f['sp'] and new['definition'] != f['definition']
+    assert "'='" in new.thaw().peg('definition')
+    assert f.nullable(f['grammar']) and not f.nullable(f['definition'])
+    # analyses of nodes without refs carry over to later versions
+    arrow = f.pool(T.lit, '<-')
+    assert not f.nullable(arrow)
+    assert ('nullable', arrow) in new.pool.memo
+    # so do the in-place rewrites of Grammar, leaving the old version alone
+    lr = Grammar()
+    lr['a'] = first(seq(lr['a'], lit(' bap')), lit('boom'))
+    lr['b'] = lit('boom')
+    old = lr.freeze(f.pool)
+    new = old.rewrite('remove_lr', 'a')
+    assert old.thaw().peg() == lr.peg() and new.thaw().peg() != lr.peg()
+    assert new['b'] == old['b'] and new['a'] != old['a']
+    assert ('nullable', arrow) in new.pool.memo
+    # the same answers as the analysis, for terminals too
+    g = Grammar()
+    g['a'] = seq(regex('x*'), lit(''))
+    g['b'] = seq(regex('x+'), g['a'])
+    f = g.freeze()
+    for k in g:
+        assert f.nullable(f[k]) == g.analysis.nullable(g[k])
+
+
+def test_diff():
+    g = Grammar.meta()
+    h = Grammar.meta()
+    assert g.diff(h) == set()
+    h['EOL'] = first(lit('\n'), lit(';'))
+    h['extra'] = lit('x')
+    assert g.diff(h) == h.diff(g) == {'EOL', 'extra'}
+    # sp uses EOL, so it depends on it, but its own body is the same
+    assert 'sp' in g.analysis.dependents({'EOL'}) and 'sp' not in g.diff(h)
+    assert g.analysis.dependents({'grammar'}) == {'grammar'}
 
 
 if __name__ == "__main__":
@@ -54,32 +54,35 @@ class JVM(ByteVM):
     def __init__(self, ast:node|bytes|bytearray|None=None):
         super().__init__(ast)
         self.arrays:list[list] = []
+        self.locals:dict[int, Any] = {}
 
     # HELPERS
     def loadclass(self, classfile):
         raise NotImplemented
     # java struct types to struct format specifiers
     structs = {
-            'byte'  :('c', struct.calcsize('c')),
-            'short' :('h', struct.calcsize('h')),
-            'int'   :('i', struct.calcsize('i')),
-            'long'  :('q', struct.calcsize('q')),
-            'float' :('f', struct.calcsize('f')),
-            'double':('d', struct.calcsize('d')),
-            'bool'  :('?', struct.calcsize('?')),
-            'char'  :('', struct.calcsize('')), # not sure here, 2 bytes per character?
+            'byte'  :'b',
+            'short' :'h',
+            'int'   :'i',
+            'long'  :'q',
+            'float' :'f',
+            'double':'d',
+            'bool'  :'?',
+            'char'  :'H', # a UTF-16 code unit
             }
     def spush(self, kind, value):
         """push struct"""
-        fmt, size = self.structs[kind]
-        struct.pack_into(fmt, self.stack, self.SP, value)
-        self.SP += size
+        self.push(value, self.structs[kind])
 
     def spop(self, kind):
         """pop struct"""
-        fmt, size = self.structs[kind]
-        self.SP -= size
-        return struct.unpack_from(fmt, self.stack, self.SP)
+        # the pop opcode shadows ByteVM.pop
+        return ByteVM.pop(self, self.structs[kind])
+
+    @staticmethod
+    def wrap(value:int) -> int:
+        """overflow an int the way java does."""
+        return (value + 2**31) % 2**32 - 2**31
 
     def ipopidx(self):
         idx = self.ipop() << 8
@@ -234,11 +237,10 @@ class JVM(ByteVM):
         arrayref = self.pop()
 
 
-    @opcode(0x10, 'b')
+    @opcode(0x10, 'b', effect=('', 'i'), pure=True)
     def bipush(self, byte):
         """Push a byte onto the stack as an integer value."""
-        # TODO
-        self.push(value)
+        self.spush('int', byte)
 
 
     @opcode(0xca)
@@ -479,13 +481,12 @@ class JVM(ByteVM):
         self.push(result)
 
 
-    @opcode(0x59)
+    @opcode(0x59, effect=('i', 'ii'), pure=True)
     def dup(self):
         """Duplicate the value on top of the stack."""
-        # TODO
-        value = self.pop()
-        self.push(value)
-        self.push(value)
+        value = self.spop('int')
+        self.spush('int', value)
+        self.spush('int', value)
 
 
     @opcode(0x5a)
@@ -843,13 +844,12 @@ class JVM(ByteVM):
         self.push(result)
 
 
-    @opcode(0x60)
+    @opcode(0x60, effect=('ii', 'i'), pure=True)
     def iadd(self):
         """Add two ints."""
-        # TODO
-        value2 = self.pop()
-        value1 = self.pop()
-        self.push(result)
+        value2 = self.spop('int')
+        value1 = self.spop('int')
+        self.spush('int', self.wrap(value1 + value2))
 
 
     @opcode(0x2e)
@@ -879,53 +879,46 @@ class JVM(ByteVM):
         arrayref = self.pop()
 
 
-    @opcode(0x02)
+    @opcode(0x02, effect=('', 'i'), pure=True)
     def iconst_m1(self):
         """Load the int value −1 onto the stack."""
-        # TODO
-        self.push(-1)
+        self.spush('int', -1)
 
 
-    @opcode(0x03)
+    @opcode(0x03, effect=('', 'i'), pure=True)
     def iconst_0(self):
         """Load the int value 0 onto the stack."""
-        # TODO
-        self.push(0)
+        self.spush('int', 0)
 
 
-    @opcode(0x04)
+    @opcode(0x04, effect=('', 'i'), pure=True)
     def iconst_1(self):
         """Load the int value 1 onto the stack."""
-        # TODO
-        self.push(1)
+        self.spush('int', 1)
 
 
-    @opcode(0x05)
+    @opcode(0x05, effect=('', 'i'), pure=True)
     def iconst_2(self):
         """Load the int value 2 onto the stack."""
-        # TODO
-        self.push(2)
+        self.spush('int', 2)
 
 
-    @opcode(0x06)
+    @opcode(0x06, effect=('', 'i'), pure=True)
     def iconst_3(self):
         """Load the int value 3 onto the stack."""
-        # TODO
-        self.push(3)
+        self.spush('int', 3)
 
 
-    @opcode(0x07)
+    @opcode(0x07, effect=('', 'i'), pure=True)
     def iconst_4(self):
         """Load the int value 4 onto the stack."""
-        # TODO
-        self.push(4)
+        self.spush('int', 4)
 
 
-    @opcode(0x08)
+    @opcode(0x08, effect=('', 'i'), pure=True)
     def iconst_5(self):
         """Load the int value 5 onto the stack."""
-        # TODO
-        self.push(5)
+        self.spush('int', 5)
 
 
     @opcode(0x6c)
@@ -1064,39 +1057,34 @@ class JVM(ByteVM):
 
 
 
-    @opcode(0x15, 'B')
+    @opcode(0x15, 'B', effect=('', 'i'))
     def iload(self, index):
         """Load an int value from a local variable #index."""
-        # TODO
-        self.push(value)
+        self.spush('int', self.locals[index])
 
 
-    @opcode(0x1a)
+    @opcode(0x1a, effect=('', 'i'), load=0)
     def iload_0(self):
         """Load an int value from local variable 0."""
-        # TODO
-        self.push(value)
+        self.spush('int', self.locals[0])
 
 
-    @opcode(0x1b)
+    @opcode(0x1b, effect=('', 'i'), load=1)
     def iload_1(self):
         """Load an int value from local variable 1."""
-        # TODO
-        self.push(value)
+        self.spush('int', self.locals[1])
 
 
-    @opcode(0x1c)
+    @opcode(0x1c, effect=('', 'i'), load=2)
     def iload_2(self):
         """Load an int value from local variable 2."""
-        # TODO
-        self.push(value)
+        self.spush('int', self.locals[2])
 
 
-    @opcode(0x1d)
+    @opcode(0x1d, effect=('', 'i'), load=3)
     def iload_3(self):
         """Load an int value from local variable 3."""
-        # TODO
-        self.push(value)
+        self.spush('int', self.locals[3])
 
 
     @opcode(0xfe)
@@ -1113,13 +1101,12 @@ class JVM(ByteVM):
 
 
 
-    @opcode(0x68)
+    @opcode(0x68, effect=('ii', 'i'), pure=True)
     def imul(self):
         """Multiply two integers."""
-        # TODO
-        value2 = self.pop()
-        value1 = self.pop()
-        self.push(result)
+        value2 = self.spop('int')
+        value1 = self.spop('int')
+        self.spush('int', self.wrap(value1 * value2))
 
 
     @opcode(0x74)
@@ -1235,48 +1222,42 @@ class JVM(ByteVM):
         self.push(result)
 
 
-    @opcode(0x36, 'B')
+    @opcode(0x36, 'B', effect=('i', ''))
     def istore(self, index):
         """Store int value into variable #index."""
-        # TODO
-        value = self.pop()
+        self.locals[index] = self.spop('int')
 
 
-    @opcode(0x3b)
+    @opcode(0x3b, effect=('i', ''), store=0)
     def istore_0(self):
         """Store int value into variable 0."""
-        # TODO
-        value = self.pop()
+        self.locals[0] = self.spop('int')
 
 
-    @opcode(0x3c)
+    @opcode(0x3c, effect=('i', ''), store=1)
     def istore_1(self):
         """Store int value into variable 1."""
-        # TODO
-        value = self.pop()
+        self.locals[1] = self.spop('int')
 
 
-    @opcode(0x3d)
+    @opcode(0x3d, effect=('i', ''), store=2)
     def istore_2(self):
         """Store int value into variable 2."""
-        # TODO
-        value = self.pop()
+        self.locals[2] = self.spop('int')
 
 
-    @opcode(0x3e)
+    @opcode(0x3e, effect=('i', ''), store=3)
     def istore_3(self):
         """Store int value into variable 3."""
-        # TODO
-        value = self.pop()
+        self.locals[3] = self.spop('int')
 
 
-    @opcode(0x64)
+    @opcode(0x64, effect=('ii', 'i'), pure=True)
     def isub(self):
         """Int subtract."""
-        # TODO
-        value2 = self.pop()
-        value1 = self.pop()
-        self.push(result)
+        value2 = self.spop('int')
+        value1 = self.spop('int')
+        self.spush('int', self.wrap(value1 - value2))
 
 
     @opcode(0x7c)
@@ -1614,17 +1595,16 @@ class JVM(ByteVM):
         self.push(arrayref)
 
 
-    @opcode(0x00)
+    @opcode(0x00, effect=('', ''), pure=True)
     def nop(self):
         """Perform no operation."""
-        # TODO
 
 
 
-    @opcode(0x57)
+    @opcode(0x57, effect=('i', ''), pure=True)
     def pop(self):
         """Discard the top value on the stack."""
-        return super().pop()
+        self.spop('int')
 
 
     @opcode(0x58)
@@ -1675,11 +1655,10 @@ class JVM(ByteVM):
         arrayref = self.pop()
 
 
-    @opcode(0x11, 'h')
+    @opcode(0x11, 'h', effect=('', 'i'), pure=True)
     def sipush(self, value):
         """Push a short onto the stack as an integer value."""
-        # TODO
-        self.push(value)
+        self.spush('int', value)
 
 
     @opcode(0x5f)
@@ -1711,6 +1690,31 @@ class JVM(ByteVM):
         # TODO
 
 
+def test_peephole():
+    vm = JVM(b'')
+    code = lambda *ops: b''.join(bytes(op) + op.struct.pack(*args) for op, *args in ops)
+    vm.code = code(
+        # x = 2 * (100 + 27), then overwritten before it's read
+        (vm.bipush, 100), (vm.bipush, 27), (vm.iadd,), (vm.iconst_2,), (vm.imul,), (vm.istore_1,),
+        (vm.iconst_5,), (vm.iconst_1,), (vm.isub,), (vm.istore_1,),
+        (vm.iload_1,), (vm.dup,), (vm.imul,),
+    )
+    vm()
+    before = vm.spop('int')
+    vm.code = vm.peephole()
+    # the first store is dead, so everything that computed its value goes with it
+    assert vm.code == code((vm.iconst_4,), (vm.istore_1,), (vm.iload_1,), (vm.dup,), (vm.imul,))
+    vm()
+    assert vm.spop('int') == before == 16
+    # a result no push instruction can hold isn't folded, and a wider one needs sipush
+    vm.code = code((vm.sipush, 2**15 - 1), (vm.sipush, 2**15 - 1), (vm.imul,))
+    vm()
+    assert vm.spop('int') == JVM.wrap((2**15 - 1) ** 2)
+    assert vm.peephole() == vm.code
+    vm.code = code((vm.bipush, 100), (vm.bipush, 100), (vm.iadd,))
+    assert vm.peephole() == code((vm.sipush, 200))
+
+
 if __name__ == "__main__":
     c = Class.from_file('HelloWorld.class')
     print(c.magic)
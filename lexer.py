@@ -0,0 +1,221 @@
+"""
+a lexer built from the token rules of a grammar, and parsing over its tokens.
+
+Each token rule must be regular (see Grammar.pattern), and they are compiled
+into one alternation, tried in the order given, like prep in 4th.py.
+Skip rules (whitespace, comments) are lexed the same way, but dropped from the stream.
+
+Parsers work on strings, so the token stream is a string too,
+with one character per token: the kind of the token, from a private use block.
+RegexLexer.grammar() replaces the body of each token rule with a lit() of its kind character,
+so Packrat, Pika or PegVM can parse the token stream without knowing about tokens,
+and their memo tables are indexed by token instead of by character.
+TokenParser moves the resulting match back to character offsets.
+"""
+from array import array
+import re
+from typing import Iterable, Iterator
+
+from base import CompileError, Lexer, Parser, SourceMap, lexen, match
+from grammar import Grammar, T, label, lit
+from packrat import Packrat
+
+# the kind of the i'th token rule is chr(_KIND + i)
+_KIND = 0xE000
+
+
+class RegexLexer:
+    def __init__(self, g: Grammar, tokens: Iterable[str], skip: Iterable[str] = ()):
+        self.g = g
+        self.tokens = tuple(tokens)
+        self.skip = frozenset(skip)
+        names = self.tokens + tuple(sorted(self.skip - set(self.tokens)))
+        parts = []
+        self._group: dict[int, str] = {}
+        group = 1
+        for name in names:
+            body = g[name]
+            if body[0] == T.label:
+                # a label around the whole token is kept by the grammar for tokens
+                body = body[2]
+            p = g.pattern(body)
+            if p is None:
+                raise CompileError(f'token rule is not regular: {g.peg(name)}')
+            if re.fullmatch(p, '') is not None:
+                raise CompileError(f'token rule can match the empty string: {g.peg(name)}')
+            self._group[group] = name
+            group += re.compile(p).groups + 1
+            parts.append(f'({p})')
+        self.pattern = re.compile('|'.join(parts))
+        self.codes = {name: chr(_KIND + i) for i, name in enumerate(self.tokens)}
+
+    def lex(self, text: str) -> Iterator[lexen]:
+        """every token, including skipped ones, styled by the name of its rule."""
+        for name, start, stop in self._scan(text):
+            yield lexen(name, text[start:stop])
+
+    def scan(self, text: str) -> tuple[str, array, array]:
+        """the token stream as a string of kinds, and the start and stop of each token in text."""
+        kinds = []
+        starts, stops = array('L'), array('L')
+        for name, start, stop in self._scan(text):
+            if name not in self.skip:
+                kinds.append(self.codes[name])
+                starts.append(start)
+                stops.append(stop)
+        return ''.join(kinds), starts, stops
+
+    def _scan(self, text: str) -> Iterator[tuple[str, int, int]]:
+        pos = 0
+        while pos < len(text):
+            m = self.pattern.match(text, pos)
+            if m is None or m.end() == pos:
+                # a token that only looks ahead matches nothing, and would never get past here
+                src = SourceMap(text)
+                what = 'no token matches' if m is None else f'{self._group[m.lastindex]} matches nothing'
+                raise src.error(f'{what} at {src.pos(pos)}', pos)
+            # the group of the alternative closes last, after any groups inside it
+            yield self._group[m.lastindex], pos, m.end()
+            pos = m.end()
+
+    def grammar(self) -> Grammar:
+        """
+        a copy of the grammar which parses the token stream.
+
+        Token rules match their kind character, keeping a label around the whole rule.
+        Skip rules aren't in the stream, so they're dropped from the sequences and choices they're in,
+        along with anything made only of them, like (ws / comment)*.
+        Turning them into lit('') instead would make a loop over them nullable.
+        Anywhere else they match nothing.
+        """
+        g = self.g.copy()
+        skipped = {id(g[name]) for name in self.skip}
+        for t in g.terms():
+            kids = [x for x in t[1:] if isinstance(x, list)]
+            if id(t) not in skipped and kids and t[0] in (T.seq, T.first, T.zed, T.one, T.opt):
+                if all(id(x) in skipped for x in kids):
+                    skipped.add(id(t))
+                elif t[0] in (T.seq, T.first) and any(id(x) in skipped for x in kids):
+                    g._replace(t, [t[0], *(x for x in t[1:] if id(x) not in skipped)])
+        for name in self.skip:
+            g._replace(g[name], lit(''))
+        for name, kind in self.codes.items():
+            body = g[name]
+            g._replace(body, label(body[1], lit(kind)) if body[0] == T.label else lit(kind))
+        return g
+
+
+class TokenParser:
+    """parse the tokens of text with a parser class like Packrat, Pika or PegVM."""
+    def __init__(self, lexer: RegexLexer, parser: type = Packrat, startRule: str = 'grammar'):
+        self.lexer = lexer
+        self.parser = parser(lexer.grammar(), startRule)
+
+    @property
+    def kinds(self) -> set[str]:
+        return self.parser.kinds
+
+    def ast(self, text: str):
+        return self.parse(text).ast(text)
+
+    def parse(self, text: str) -> match:
+        kinds, starts, stops = self.lexer.scan(text)
+        starts.append(len(text))
+        m = self.parser.parse(kinds)
+        # token i starts at starts[i], a match ending after token i stops at stops[i-1]
+        return _remap(m, starts, stops)
+
+
+def _remap(m: match, starts: array, stops: array) -> match:
+    """move a match over tokens to character offsets."""
+    done: dict[int, match] = {}
+    stack = [m]
+    while stack:
+        n = stack[-1]
+        todo = [c for c in n.content if id(c) not in done]
+        if todo:
+            stack.extend(todo)
+            continue
+        stack.pop()
+        start = starts[n.start]
+        done[id(n)] = n._replace(
+            start=start,
+            stop=stops[n.stop - 1] if n.stop > n.start else start,
+            content=tuple(done[id(c)] for c in n.content),
+        )
+    return done[id(m)]
+
+
+def _calc() -> Grammar:
+    from grammar import char, dot, first, no, one, seq, zed
+    g = Grammar()
+    g['ws'] = one(char(' ', '\t', '\n'))
+    g['comment'] = seq(lit('#'), zed(seq(no(lit('\n')), dot())))
+    g['num'] = label('num', one(char('09')))
+    g['name'] = label('name', seq(char('az'), zed(char('az', '09'))))
+    g['op'] = label('op', first(lit('**'), char('+', '-', '*', '/')))
+    g['lp'] = lit('(')
+    g['rp'] = lit(')')
+    g['atom'] = first(g['num'], g['name'], seq(g['lp'], g['expr'], g['rp']))
+    g['expr'] = label('expr', seq(g['atom'], zed(seq(g['op'], g['atom']))))
+    g['grammar'] = seq(g['expr'], no(dot()))
+    return g
+
+
+def test_lex():
+    L = RegexLexer(_calc(), ['num', 'name', 'op', 'lp', 'rp'], skip=['ws', 'comment'])
+    text = 'x1 ** (2+y) # done\n'
+    assert [(t.style, t.content) for t in L.lex(text)] == [
+        ('name', 'x1'), ('ws', ' '), ('op', '**'), ('ws', ' '), ('lp', '('), ('num', '2'),
+        ('op', '+'), ('name', 'y'), ('rp', ')'), ('ws', ' '), ('comment', '# done'), ('ws', '\n'),
+    ]
+    kinds, starts, stops = L.scan(text)
+    assert len(kinds) == 7 and list(starts[:3]) == [0, 3, 6] and stops[-1] == 11
+    assert isinstance(L, Lexer) and isinstance(TokenParser(L), Parser)
+
+
+def test_tokens():
+    from pika import Pika
+    from pegvm import PegVM
+    L = RegexLexer(_calc(), ['num', 'name', 'op', 'lp', 'rp'], skip=['ws', 'comment'])
+    text = '(a + 12)*b3 # comment\n - 4'
+    want = [('expr',
+        ('expr', ('name', 'a'), ('op', '+'), ('num', '12')),
+        ('op', '*'), ('name', 'b3'), ('op', '-'), ('num', '4'),
+    )]
+    for P in (Packrat, Pika, PegVM):
+        assert list(TokenParser(L, P).ast(text)) == want
+    try:
+        L.scan('a $ b')
+        assert False, 'should not lex'
+    except SyntaxError as e:
+        assert e.offset == 3
+
+
+def test_skip():
+    """skip rules inside a loop don't make it nullable, and empty tokens don't hang."""
+    from grammar import yes, first, seq, zed
+    from pika import Pika
+    from pegvm import PegVM
+    g = _calc()
+    g['items'] = label('items', zed(first(g['ws'], g['name'], seq(g['ws'], g['num']))))
+    g['grammar'] = seq(g['items'], g['comment'])
+    L = RegexLexer(g, ['num', 'name'], skip=['ws', 'comment'])
+    lexed = L.grammar()
+    assert not lexed.nullable(lexed['items'][2][1])
+    text = 'a 1 b # end'
+    want = [('items', ('name', 'a'), ('num', '1'), ('name', 'b'))]
+    for P in (Packrat, Pika, PegVM):
+        assert list(TokenParser(L, P).ast(text)) == want
+    g['look'] = yes(lit('a'))
+    L = RegexLexer(g, ['look', 'name'], skip=['ws'])
+    try:
+        L.scan('b a')
+        assert False, 'should not lex'
+    except SyntaxError as e:
+        assert e.offset == 3
+
+
+if __name__ == "__main__":
+    import pytest
+    pytest.main([__file__])
@@ -1,9 +1,145 @@
-from functools import cache
-from base import ParseError, Parser, match
-from grammar import Grammar, T
+import re
+from typing import Callable
+
+from analysis import Analysis
+from base import ParseError, Parser, SourceMap, match
+from charset import EOF, CharSet
+from grammar import Grammar, Pool, T
+
+type _memo = list[dict[int, match|None]]
+type _clause = Callable[[str, int, _memo], match|None]
+
+# marks a memo entry which hasn't been tried yet, since None is a cached failure
+_miss = object()
+
+
+def _compile(t, call:Callable[[list], _clause], a:Analysis|None = None) -> _clause:
+    """
+    build the closure for a single term. call() gets the memoized clause of a child term.
+
+    if given an analysis, ordered choice only tries alternatives which can start with the next character.
+    """
+    match t:
+        # terminals
+        case [T.dot]:
+            def f(src, idx, memo):
+                if idx < len(src):
+                    return match(idx, idx+1)
+        case [T.lit, v]:
+            assert isinstance(v, str)
+            size = len(v)
+            def f(src, idx, memo):
+                if src.startswith(v, idx):
+                    return match(idx, idx+size)
+        case [T.char | T.ichar, *spec]:
+            cs = CharSet.from_spec(spec)
+            if t[0] == T.ichar:
+                cs = ~cs
+            def f(src, idx, memo):
+                if idx < len(src) and src[idx] in cs:
+                    return match(idx, idx+1)
+        case [T.re, pattern]:
+            rx = re.compile(pattern)
+            def f(src, idx, memo):
+                if (m := rx.match(src, idx)):
+                    return match(idx, m.end())
+        # non-terminals
+        case [T.label, lname, term]:
+            inner = call(term)
+            def f(src, idx, memo):
+                m = inner(src, idx, memo)
+                if m is not None:
+                    return m._replace(label=lname)
+        case [T.seq, left, right]:
+            l_, r_ = call(left), call(right)
+            def f(src, idx, memo):
+                if (l:=l_(src, idx, memo)) is None:
+                    return None
+                if (r:=r_(src, l.stop, memo)) is None:
+                    return None
+                return match(idx, r.stop, content=(l, r))
+        case [T.seq, *terms]:
+            parts = tuple(map(call, terms))
+            def f(src, idx, memo):
+                content = []
+                stop = idx
+                for p in parts:
+                    if (m:=p(src, stop, memo)) is None:
+                        return None
+                    content.append(m)
+                    stop = m.stop
+                return match(idx, stop, content=tuple(content))
+        case [T.first, *terms] if a is not None:
+            info = tuple((call(x), a.first(x), a.nullable(x)) for x in terms)
+            # next character -> alternatives worth trying
+            table:dict[str, tuple[_clause, ...]] = {}
+            def f(src, idx, memo):
+                c = src[idx] if idx < len(src) else EOF
+                if (parts := table.get(c)) is None:
+                    parts = table[c] = tuple(
+                        p for p, fs, n in info
+                        if n or c in fs
+                    )
+                for p in parts:
+                    if (m:=p(src, idx, memo)):
+                        return m
+        case [T.first, *terms]:
+            parts = tuple(map(call, terms))
+            def f(src, idx, memo):
+                for p in parts:
+                    if (m:=p(src, idx, memo)):
+                        return m
+        case [T.no, term]:
+            inner = call(term)
+            def f(src, idx, memo):
+                if inner(src, idx, memo) is None:
+                    return match(idx, idx)
+        case _:
+            raise ValueError(t)
+    return f
+
+
+def _common(a:str, b:str) -> int:
+    """length of the common prefix of a and b, comparing slices so it runs at C speed."""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _diff(old:str, text:str) -> tuple[int, int, str]:
+    """the edit old[start:stop] = new which turns old into text, keeping the longest common prefix and suffix."""
+    p = _common(old, text)
+    s = min(_common(old[::-1], text[::-1]), len(old) - p, len(text) - p)
+    return p, len(old) - s, text[p:len(text) - s]
+
+
+def _shift(m:match|None, delta:int, seen:dict[int, match]) -> match|None:
+    """move a match tree by delta characters. shared subtrees stay shared."""
+    if m is None or not delta:
+        return m
+    if id(m) not in seen:
+        seen[id(m)] = m._replace(
+            start=m.start+delta,
+            stop=m.stop+delta,
+            content=tuple(_shift(c, delta, seen) for c in m.content),
+        )
+    return seen[id(m)]
+
 
 class Packrat:
-    def __init__(self, g:Grammar|str|None = None, startRule:str = 'grammar'):
+    """
+    With incremental=True the memo of the last parse is kept,
+    and each entry also records how far into the text it looked (its reach),
+    and the furthest position anything under it was tried at, for errors.
+    The next parse keeps entries which only looked at the unchanged prefix,
+    and moves entries inside the unchanged suffix to their new position.
+    """
+    def __init__(self, g:Grammar|str|None = None, startRule:str = 'grammar', incremental:bool = False):
         match g:
             case str():
                 g = Grammar.from_ast(Packrat().parse(g).ast(g))
@@ -14,16 +150,81 @@ class Packrat:
             case _:
                 raise ValueError(g)
 
-        g.reduce(startRule)
-        g.remove_lr(startRule)
+        self.incremental = incremental
+        # the lines of the last text, kept in step with each edit, and the memo of its parse
+        self._last:tuple[SourceMap, _memo]|None = None
+        # exclusive bound of the text examined so far by the clause being tried
+        self._extent = [0]
+        # the furthest position a clause was tried at by the clause being tried, for errors
+        self._far = [0]
+        self._start = startRule
+        self._pool = Pool()
+        # work on a copy, so the grammar given can be edited and passed to update()
+        self._source = g.freeze(self._pool)
+        self._load(self._source.thaw())
+
+    def _load(self, g:Grammar, dirty:frozenset[str]|None = None):
+        """
+        reduce g and compile it. clauses are identified by their position in self.terms.
+
+        Clauses are also keyed by their structure, so if dirty is given,
+        a term equal to one compiled before which doesn't use a dirty rule keeps its closure.
+        Otherwise everything is compiled again.
+        """
+        g.reduce(self._start)
+        g.remove_lr(self._start)
+        g.inline(self._start)
         g.validate()
-        self.terms = {id(t):t for t in g.terms(startRule)}
-        self.startRule = id(g[startRule])
-        self._kinds:set[str] = set(
-        t[1] for t in self.terms.values() if t[0] == T.label
+        nodes:dict[int, int] = {}
+        reduced = g.freeze(self._pool, nodes)
+        if dirty is None:
+            self.terms:tuple = ()
+            self.clauses:tuple[_clause, ...] = ()
+            self._impl:list[_clause] = []
+            self._cIs:dict[int, int] = {}
+            self._last = None
+        else:
+            dirty = g.analysis.dependents(dirty | (self._reduced.diff(reduced) & g.keys()))
+        self._reduced = reduced
 
+        terms = list(self.terms)
+        fresh = len(terms)
+        self.ids = {}
+        for t in g.terms(self._start):
+            n = nodes[id(t)]
+            cI = self._cIs.get(n)
+            if cI is None or cI < fresh and self._pool.refs(n) & dirty:
+                cI = self._cIs[n] = len(terms)
+                terms.append(t)
+            else:
+                terms[cI] = t
+            self.ids[id(t)] = cI
+        self.terms = tuple(terms)
+        self.startRule = self.ids[id(g[self._start])]
+        self.clauses = self._compile(g.analysis, fresh)
+        self._kinds:set[str] = set(
+            t[1] for t in g.terms(self._start) if t[0] == T.label
         )
 
+    def update(self, g:Grammar) -> set[str]:
+        """
+        switch to grammar g, and return the names of the rules which changed.
+
+        Only the terms of changed rules and the rules which use them are compiled,
+        and an incremental parser keeps the memo entries of everything else.
+        Retired clauses are kept until they outnumber the live ones, then everything is compiled again.
+        """
+        source = g.freeze(self._pool)
+        changed = self._source.diff(source)
+        if not changed:
+            return changed
+        self._source = source
+        if len(self.terms) > 2 * len(self.ids):
+            self._load(source.thaw())
+        else:
+            self._load(source.thaw(), frozenset(changed & g.keys()))
+        return changed
+
     @property
     def kinds(self) -> set[str]:
         return self._kinds
@@ -32,54 +233,123 @@ class Packrat:
         return self.parse(text).ast(text)
 
     def parse(self, text:str) -> match:
-        # TODO attempt partial cache eviction
-        # store old attempts in radix tree
-        self._match.cache_clear()
-        m = self._match(self.startRule, text, 0)
+        # one memo table per clause, keyed by position.
+        # it belongs to this parse only, and is released when we return,
+        # unless the parser is incremental.
+        src = None
+        if self._last is None:
+            memo:_memo = [{} for _ in self.terms]
+        else:
+            src, memo = self._last
+            edit = _diff(src.text, text)
+            memo = self._reuse(memo, *edit)
+        self._extent[0] = self._far[0] = 0
+        try:
+            m = self.clauses[self.startRule](text, 0, memo)
+        except BaseException:
+            # the memo may be half written, so the next parse starts over
+            self._last = None
+            raise
+        if self.incremental:
+            if src is None:
+                src = SourceMap(text)
+            else:
+                src.edit(*edit)
+            self._last = (src, memo)
         if m is None:
-            # TODO inspect cache to find the longest match
-            # use that to enrich the error here
-            raise ParseError(
-                ('packrat failed','__stdin__', 0, 0, text),
-            )
+            # the furthest position any clause was tried at is the best guess of where it went wrong.
+            # an incremental memo holds entries from earlier parses, so each entry records its own
+            if self.incremental:
+                far = self._far[0]
+            else:
+                far = max((max(row, default=0) for row in memo), default=0)
+            src = src or SourceMap(text)
+            raise src.error(f'packrat failed at {src.pos(far)}', far, filename='__stdin__')
         return m
 
-    @cache
-    def _match(self, c, src:str, idx:int) -> match|None:
-        c = self.terms[c]
-        match c:
-            # terminals
-            case [T.dot]:
-                if idx < len(src):
-                    return match(idx, idx+1)
-            case [T.lit, v]:
-                assert isinstance(v, str)
-                if src.startswith(v, idx):
-                    return match(idx, idx+len(v))
-            case [T.char| T.ichar, *spec]:
-                if idx < len(src) and (c[0] == T.ichar) ^ any(x[0] <= src[idx] <= x[-1] for x in spec):
-                    return match(idx, idx+1)
-            # non-terminals
-            case [T.label, lname, term]:
-                m = self._match(id(term), src, idx)
-                if m is not None:
-                    return m._replace(label=lname)
-            case [T.seq, left, right]:
-                if (l:=self._match(id(left), src, idx)) is None:
-                    return None
-                if (r:=self._match(id(right), src, l.stop)) is None:
-                    return None
-                return match(idx, r.stop, content=(l, r))
-            case [T.first, *c]:
-                for x in c:
-                    if (m:=self._match(id(x), src, idx)):
-                        return m
-            case [T.no, term]:
-                if (m:=self._match(id(term), src, idx)) is None:
-                    return match(idx, idx)
-            case _:
-                raise ValueError(c)
+    def _reuse(self, memo:_memo, p:int, start:int, inserted:str) -> _memo:
+        """
+        carry the entries of the last parse that can't be affected by the edit.
 
+        The edit replaced old[p:start] with inserted.
+        An entry that looked at old[idx:reach] is still valid if reach <= p,
+        or if idx is in the suffix old[start:], in which case it moves by the change in length.
+        Entries which looked at the end of the text have reach len(old)+1,
+        so they are only kept if the end didn't move relative to them.
+        The furthest position tried under an entry is never past its reach, so it moves the same way.
+        """
+        delta = len(inserted) - (start - p)
+        seen:dict[int, match] = {}
+        out:_memo = [{} for _ in self.terms]
+        for row, new in zip(memo, out):
+            for idx, (m, reach, far) in row.items():
+                if reach <= p:
+                    new[idx] = (m, reach, far)
+                elif idx >= start:
+                    new[idx+delta] = (_shift(m, delta, seen), reach+delta, far+delta)
+        return out
+
+    def _compile(self, a:Analysis|None = None, start:int = 0) -> tuple[_clause, ...]:
+        """
+        turn every term from start on into a closure with its children bound directly.
+
+        This replaces a lookup and a structural match per (clause, position)
+        with a single call, while keeping one memo table per clause.
+        """
+        impl = self._impl
+
+        def memoized(cI:int) -> _clause:
+            def call(src:str, idx:int, memo:_memo) -> match|None:
+                row = memo[cI]
+                m = row.get(idx, _miss)
+                if m is _miss:
+                    m = row[idx] = impl[cI](src, idx, memo)
+                return m
+            return call
+
+        extent, furthest = self._extent, self._far
+        def tracked(cI:int) -> _clause:
+            # terminals look at as many characters as they could match.
+            # a regex could look anywhere after idx, so assume it read to the end.
+            match self.terms[cI]:
+                case [T.dot] | [T.char | T.ichar, *_]:
+                    size = 1
+                case [T.lit, v]:
+                    size = len(v)
+                case [T.re, _]:
+                    size = None
+                case _:
+                    size = 0
+            def call(src:str, idx:int, memo:_memo) -> match|None:
+                row = memo[cI]
+                hit = row.get(idx)
+                if hit is not None:
+                    m, reach, far = hit
+                    if reach > extent[0]:
+                        extent[0] = reach
+                    if far > furthest[0]:
+                        furthest[0] = far
+                    return m
+                outer, outer_far = extent[0], furthest[0]
+                extent[0] = len(src) + 1 if size is None else idx + size
+                furthest[0] = idx
+                m = impl[cI](src, idx, memo)
+                reach, far = extent[0], furthest[0]
+                row[idx] = (m, reach, far)
+                if outer > reach:
+                    extent[0] = outer
+                if outer_far > far:
+                    furthest[0] = outer_far
+                return m
+            return call
+
+        wrap = tracked if self.incremental else memoized
+        calls = [*self.clauses, *(wrap(cI) for cI in range(start, len(self.terms)))]
+        # dispatch reads the next character, which incremental reach doesn't account for
+        a = None if self.incremental else a
+        for t in self.terms[start:]:
+            impl.append(_compile(t, lambda x: calls[self.ids[id(x)]], a))
+        return tuple(calls)
 
 def test_meta():
     """this is proof of the fixed point grammar."""
@@ -91,6 +361,110 @@ def test_meta():
     assert defined.peg() == calc.peg()
     
 
+def test_memo():
+    """the memo belongs to a single parse, so parsers don't share entries."""
+    a, b = Packrat(), Packrat()
+    src = Grammar.meta().peg()
+    assert list(a.ast(src)) == list(b.ast(src))
+    try:
+        a.parse('bogus <- 123')
+        assert False, 'should not parse'
+    except ParseError:
+        pass
+    assert list(b.ast(src)) == list(a.ast(src))
+
+
+def test_incremental():
+    """reparsing after an edit gives the same tree as a fresh parse."""
+    src = Grammar.meta().peg()
+    P = Packrat(incremental=True)
+    i = src.index('\n', len(src) // 2) + 1
+    edits = [
+        src,
+        src[:i] + 'extra <- "x" [a-z]*\n' + src[i:],
+        src[:i] + src[src.index('\n', i) + 1:],
+        src + 'tail <- .\n',
+        'head <- .\n' + src,
+        src,
+    ]
+    last = ''
+    for text in edits:
+        if P._last is not None:
+            kept = sum(map(len, P._reuse(P._last[1], *_diff(P._last[0].text, text))))
+            assert kept, 'some entries should survive the edit'
+        assert list(P.ast(text)) == list(Packrat().ast(text))
+        # the lines are edited rather than rebuilt
+        assert P._last[0].text == text
+        assert P._last[0].starts == SourceMap(text).starts
+        last = text
+    try:
+        P.parse(last + ' <- ')
+        assert False, 'should not parse'
+    except ParseError:
+        pass
+    assert list(P.ast(src)) == list(Packrat().ast(src))
+
+
+def test_incremental_errors():
+    """errors are reported where a fresh parse would, and an interrupted parse doesn't leave stale state."""
+    def where(P, text):
+        try:
+            P.parse(text)
+        except ParseError as e:
+            return e.lineno, e.offset
+    src = Grammar.meta().peg()
+    i = src.index('\n') + 1
+    P = Packrat(incremental=True)
+    P.parse(src)
+    bad = src[:20] + '<- <-' + src[20:]
+    assert where(P, bad) == where(Packrat(), bad) is not None
+    P.parse(src)
+    try:
+        P.parse(src[:i] + 'x <- ' + '(' * 1000 + src[i:])
+        assert False, 'should recurse too deep'
+    except RecursionError:
+        pass
+    assert P._last is None
+    bad = src[:i] + 'x <- ' + src[i:]
+    assert where(P, bad) == where(Packrat(), bad) is not None
+
+
+def test_regex():
+    """collapsing terminals into regex doesn't change the ast."""
+    src = Grammar.meta().peg()
+    g = Grammar.meta()
+    g.enable_regex()
+    assert any(t[0] == T.re for t in g.terms())
+    assert list(Packrat(g).ast(src)) == list(Packrat().ast(src))
+    P = Packrat(g, incremental=True)
+    P.parse(src)
+    assert list(P.ast(src + 'x <- y\n')) == list(Packrat().ast(src + 'x <- y\n'))
+
+
+def test_update():
+    """only the changed rules and their users are compiled again."""
+    from grammar import first, lit
+    src = Grammar.meta().peg()
+    g = Grammar.meta()
+    P = Packrat(g, incremental=True)
+    P.parse(src)
+    assert P.update(g) == set()
+    size, start = len(P.terms), P.startRule
+    g['EOL'] = first(lit('\r\n'), lit('\n'), lit('\r'), lit(';'))
+    assert P.update(g) == {'EOL'}
+    assert P.startRule != start and len(P.terms) - size < size
+    # entries of unchanged clauses are kept for the next parse
+    assert sum(map(len, P._reuse(P._last[1], *_diff(P._last[0].text, src))))
+    for text in (src, src.replace('\n', ';')):
+        assert list(P.ast(text)) == list(Packrat(g).ast(text))
+    # retired clauses are dropped once they outnumber the live ones
+    for i in range(5):
+        g['EOL'] = first(lit('\n'), lit(str(i)))
+        P.update(g)
+        assert list(P.ast(src)) == list(Packrat(g).ast(src))
+    assert len(P.terms) <= 3 * len(P.ids)
+
+
 def test_proto():
     p: Parser = Packrat()
     #assert isinstance(Packrat(), Parser)
@@ -319,18 +319,18 @@ class PackratParser(Parser):
         #    ast = self.funcs[start](0)
 
         if ast is None:
-            lines = text.split('\n')
-            lineno = text.count('\n', 0, self.__extent)
+            src = SourceMap(text)
+            lineno = src.pos(self.__extent)[0] - 1
             self.error = []
             if lineno > 0:
-                self.error.append(f'{lineno-1:03}:{lines[lineno-1]}')
-                pre = text.rfind('\n', 0, self.__extent)
+                self.error.append(f'{lineno-1:03}:{src.line(lineno)}')
+                pre = src.offset(lineno + 1) - 1
             else:
                 pre = 0
-            self.error.append(f'{lineno:03}:{lines[lineno]}')
+            self.error.append(f'{lineno:03}:{src.line(lineno + 1)}')
             self.error.append('^'.rjust(self.__extent-pre + 4, ' '))
-            if lineno + 1 < len(lines):
-                self.error.append(f'{lineno+1:03}:{lines[lineno+1]}')
+            if lineno + 1 < len(src):
+                self.error.append(f'{lineno+1:03}:{src.line(lineno + 2)}')
             self.error.append(f'ParseError: failed after line={lineno} char={pre}')
             if strict:
                 raise ParseError('\n'.join(self.error))
@@ -0,0 +1,597 @@
+"""
+# what is this
+A parsing machine in the style of LPeg.
+A Grammar is compiled into instructions for a ByteVM, which runs them
+with an explicit backtrack stack instead of recursion or a memo table.
+
+see also:
+* https://www.inf.puc-rio.br/~roberto/docs/peg.pdf
+* https://www.inf.puc-rio.br/~roberto/lpeg/
+
+Without a memo, a choice between alternatives with a long common prefix
+parses that prefix again for every alternative (E3 in the meta grammar does this),
+so this trades time for memory compared to Packrat and Pika.
+
+# optimization
+optimize() is a peephole pass over the compiled program, see its docstring.
+specialize() profiles the machine on sample input, and replaces the pairs of instructions
+which run most often with superinstructions, opcodes declared to do the work of a pair.
+
+# registers
+* IP - the instruction pointer
+* pos - the current position in the subject
+
+# backtrack stack
+entries are either a return address (int), pushed by call,
+or a choice point (ip, pos, len(captures)), pushed by choice.
+On failure, return addresses are discarded until a choice point is found,
+and the machine resumes from there. If there is none, the parse failed.
+
+# captures
+open and close record (label, pos) and (None, pos) in a flat list,
+which is truncated on backtracking and folded into a match tree at the end.
+"""
+from collections import Counter
+import re
+import struct
+from typing import Iterable
+
+from base import CompileError, ParseError, SourceMap, match
+from bytecode import ByteVM, opcode
+from charset import CharSet
+from grammar import Grammar, T
+
+
+class PegVM(ByteVM):
+    def __init__(self, g: Grammar | str | None = None, startRule: str = 'grammar', optimize: bool = True):
+        match g:
+            case str():
+                g = Grammar.from_ast(PegVM().parse(g).ast(g))
+            case None:
+                g = Grammar.meta()
+            case Grammar():
+                pass
+            case _:
+                raise ValueError(g)
+
+        # the machine can't handle left recursion any better than packrat.
+        # work on a copy, so the grammar given isn't rewritten
+        g = g.copy()
+        g.remove_lr(startRule)
+        g.validate()
+        self._kinds: set[str] = {t[1] for t in g.terms(startRule) if t[0] == T.label}
+        super().__init__()
+
+        # constant pool for strings, character sets and label names
+        self.consts: list = []
+        self._program = self.program(g, startRule)
+        if optimize:
+            self._program = self.optimize(self._program)
+        self.code = bytearray(self.assemble(self._program))
+
+    @property
+    def kinds(self) -> set[str]:
+        return self._kinds
+
+    def ast(self, text: str):
+        return self.parse(text).ast(text)
+
+    def parse(self, text: str, debug: bool = False) -> match:
+        """with debug, run one step() at a time instead of the predecoded loop."""
+        self.src = text
+        self.pos = 0
+        # the furthest position a match failed at, for errors
+        self.far = 0
+        self.IP = 0
+        self.btrack: list[int | tuple[int, int, int]] = []
+        self.caps: list[tuple[int | None, int]] = []
+        if debug:
+            while self.IP < len(self.code):
+                self.step()
+        else:
+            self.run()
+
+        # fold captures into a match tree
+        stack: list[list[match]] = [[]]
+        opened: list[tuple[int, int]] = []
+        for k, pos in self.caps:
+            if k is None:
+                name, start = opened.pop()
+                content = stack.pop()
+                stack[-1].append(match(start, pos, self.consts[name], tuple(content)))
+            else:
+                opened.append((k, pos))
+                stack.append([])
+        return match(0, self.pos, content=tuple(stack[0]))
+
+    # compiler
+    def const(self, value) -> int:
+        if value not in self.consts:
+            self.consts.append(value)
+        return self.consts.index(value)
+
+    def program(self, g: Grammar, startRule: str) -> list:
+        """
+        produce a list of instructions (opcode, *args) and label definitions (str).
+
+        string arguments to an instruction refer to labels, and are resolved by assemble().
+        Every rule is compiled once as a subroutine, and references to it become calls.
+        """
+        rules: dict[int, str] = {}
+        for k, v in g.items():
+            rules.setdefault(id(v), k)
+        todo = [g[startRule]]
+        queued = {id(g[startRule])}
+        out: list = [(self.call, f'rule:{rules[id(g[startRule])]}'), (self.end,)]
+        count = 0
+
+        def new() -> str:
+            nonlocal count
+            count += 1
+            return f'L{count}'
+
+        def emit(t, top=False):
+            if not top and id(t) in rules:
+                if id(t) not in queued:
+                    queued.add(id(t))
+                    todo.append(t)
+                out.append((self.call, f'rule:{rules[id(t)]}'))
+                return
+            match t:
+                case [T.dot]:
+                    out.append((self.any,))
+                case [T.lit, s] if len(s) == 1:
+                    out.append((self.char, ord(s)))
+                case [T.lit, s]:
+                    out.append((self.string, self.const(s)))
+                case [T.char | T.ichar, *spec]:
+                    cs = CharSet.from_spec(spec)
+                    out.append((self.set, self.const(~cs if t[0] == T.ichar else cs)))
+                case [T.re, pattern]:
+                    out.append((self.regex, self.const(re.compile(pattern))))
+                case [T.ref, name]:
+                    emit(g[name])
+                case [T.label, name, term]:
+                    out.append((self.open, self.const(name)))
+                    emit(term)
+                    out.append((self.close,))
+                case [T.seq, *terms]:
+                    for x in terms:
+                        emit(x)
+                case [T.first, *terms]:
+                    done = new()
+                    for x in terms[:-1]:
+                        nxt = new()
+                        out.append((self.choice, nxt))
+                        emit(x)
+                        out.append((self.commit, done))
+                        out.append(nxt)
+                    emit(terms[-1])
+                    out.append(done)
+                case [T.no, term]:
+                    done = new()
+                    out.append((self.choice, done))
+                    emit(term)
+                    out.append((self.fail_twice,))
+                    out.append(done)
+                case [T.yes, term]:
+                    ok, done = new(), new()
+                    out.append((self.choice, ok))
+                    emit(term)
+                    out.append((self.back_commit, done))
+                    out.append(ok)
+                    out.append((self.fail,))
+                    out.append(done)
+                case [T.opt, term]:
+                    done = new()
+                    out.append((self.choice, done))
+                    emit(term)
+                    out.append((self.commit, done))
+                    out.append(done)
+                case [T.zed | T.one, term]:
+                    if g.nullable(term):
+                        raise CompileError(f'loop body can match the empty string: {g.pe(term)}')
+                    if t[0] == T.one:
+                        emit(term)
+                    loop, done = new(), new()
+                    out.append((self.choice, done))
+                    out.append(loop)
+                    emit(term)
+                    out.append((self.partial_commit, loop))
+                    out.append(done)
+                case _:
+                    raise CompileError(f'no instructions for {t}')
+
+        while todo:
+            t = todo.pop()
+            out.append(f'rule:{rules[id(t)]}')
+            emit(t, top=True)
+            out.append((self.ret,))
+        return out
+
+    def optimize(self, program: list) -> list:
+        """
+        peephole passes over a program, repeated until it stops changing.
+
+        * adjacent chars and strings are folded into one string
+        * a call followed by ret becomes a jump, so the callee returns straight to our caller
+        * a branch to a jump branches to where the jump goes
+        * a jump to the next instruction is dropped
+        * instructions after an unconditional branch are dropped up to the next label
+        * labels nothing refers to are dropped, so they don't split instructions apart
+        """
+        while (out := self._peephole(program)) != program:
+            program = out
+        return out
+
+    def _peephole(self, program: list) -> list:
+        # which instruction each label is attached to
+        at = {}
+        for x in reversed(program):
+            if isinstance(x, str):
+                at[x] = nxt
+            else:
+                nxt = x
+        used = {a for x in program if not isinstance(x, str) for a in x[1:] if isinstance(a, str)}
+        unconditional = {
+            self.jump, self.commit, self.partial_commit, self.back_commit,
+            self.ret, self.end, self.fail, self.fail_twice,
+        }
+
+        def thread(L: str) -> str:
+            seen = {L}
+            while at[L][0] is self.jump and at[L][1] not in seen:
+                L = at[L][1]
+                seen.add(L)
+            return L
+
+        out: list = []
+        dead = False
+        for x in program:
+            if isinstance(x, str):
+                if x in used:
+                    if out and out[-1] == (self.jump, x):
+                        out.pop()
+                    out.append(x)
+                    dead = False
+                continue
+            if dead:
+                continue
+            op, *args = x
+            x = (op, *(thread(a) if isinstance(a, str) else a for a in args))
+            prev = out[-1] if out and not isinstance(out[-1], str) else None
+            if prev is not None:
+                a, b = self._literal(prev), self._literal(x)
+                if a is not None and b is not None:
+                    out[-1] = (self.string, self.const(a + b))
+                    continue
+                if prev[0] is self.call and op is self.ret:
+                    out[-1] = (self.jump, prev[1])
+                    dead = True
+                    continue
+            out.append(x)
+            dead = op in unconditional
+        return out
+
+    def _literal(self, x: tuple) -> str | None:
+        """the text an instruction matches, if it only matches a fixed text."""
+        if x[0] is self.char:
+            return chr(x[1])
+        if x[0] is self.string:
+            return self.consts[x[1]]
+        return None
+
+    def specialize(self, samples: Iterable[str], n: int = 8) -> Counter:
+        """
+        replace the n pairs of instructions which run one after the other most often
+        while parsing samples with their superinstructions, and return the profile.
+
+        Pairs without a superinstruction are left alone, since calling two opcodes
+        from a generic wrapper costs about as much as dispatching them separately.
+        The profile shows which pairs would be worth writing one for.
+        """
+        self.counts = Counter()
+        for text in samples:
+            try:
+                self.parse(text)
+            except ParseError:
+                pass
+        profile, self.counts = self.counts, None
+        pairs = {}
+        for p, _ in profile.most_common():
+            if len(pairs) == n:
+                break
+            if p in self.fused:
+                pairs[p] = self.fused[p]
+        out: list = []
+        for x in self._program:
+            if out and not isinstance(x, str) and not isinstance(out[-1], str) and (out[-1][0], x[0]) in pairs:
+                out[-1] = (pairs[out[-1][0], x[0]], *out[-1][1:], *x[1:])
+            else:
+                out.append(x)
+        self.code = bytearray(self.assemble(out))
+        return profile
+
+    def assemble(self, program: list) -> bytes:
+        """resolve labels to addresses and encode instructions."""
+        labels = {}
+        IP = 0
+        for i in program:
+            if isinstance(i, str):
+                labels[i] = IP
+            else:
+                IP += i[0].size
+        return b''.join(
+            bytes(op) + struct.pack(op.argfmt, *(labels[a] if isinstance(a, str) else a for a in args))
+            for op, *args in program
+            if not isinstance(op, str)
+        )
+
+    # the machine
+    def _backtrack(self):
+        if self.pos > self.far:
+            self.far = self.pos
+        while self.btrack:
+            entry = self.btrack.pop()
+            if isinstance(entry, tuple):
+                self.IP, self.pos, n = entry
+                del self.caps[n:]
+                return
+        src = SourceMap(self.src)
+        raise src.error(f'pegvm failed at {src.pos(self.far)}', self.far, filename='__stdin__')
+
+    @opcode(0x00)
+    def end(self):
+        """the start rule matched, halt."""
+        self.IP = len(self.code)
+
+    @opcode(0x01)
+    def any(self):
+        """match any single character."""
+        if self.pos < len(self.src):
+            self.pos += 1
+        else:
+            self._backtrack()
+
+    @opcode(0x02, 'I')
+    def char(self, c):
+        """match the single character with codepoint c."""
+        if self.pos < len(self.src) and ord(self.src[self.pos]) == c:
+            self.pos += 1
+        else:
+            self._backtrack()
+
+    @opcode(0x03, 'H')
+    def string(self, k):
+        """match the literal string in constant k."""
+        s = self.consts[k]
+        if self.src.startswith(s, self.pos):
+            self.pos += len(s)
+        else:
+            # fail where the first difference is, as a char for each character would
+            n = 0
+            while self.pos + n < len(self.src) and self.src[self.pos + n] == s[n]:
+                n += 1
+            self.pos += n
+            self._backtrack()
+
+    @opcode(0x04, 'H')
+    def set(self, k):
+        """match a single character in the character set in constant k."""
+        if self.pos < len(self.src) and self.src[self.pos] in self.consts[k]:
+            self.pos += 1
+        else:
+            self._backtrack()
+
+    @opcode(0x05, 'H')
+    def regex(self, k):
+        """match the compiled regex in constant k."""
+        if (m := self.consts[k].match(self.src, self.pos)):
+            self.pos = m.end()
+        else:
+            self._backtrack()
+
+    @opcode(0x10, 'I')
+    def choice(self, L):
+        """push a choice point which resumes at L."""
+        self.btrack.append((L, self.pos, len(self.caps)))
+
+    @opcode(0x11, 'I')
+    def commit(self, L):
+        """drop the top choice point and jump to L."""
+        self.btrack.pop()
+        self.IP = L
+
+    @opcode(0x12, 'I')
+    def partial_commit(self, L):
+        """update the top choice point to the current state and jump to L."""
+        self.btrack[-1] = (self.btrack[-1][0], self.pos, len(self.caps))
+        self.IP = L
+
+    @opcode(0x13, 'I')
+    def back_commit(self, L):
+        """restore the state of the top choice point, drop it and jump to L."""
+        _, self.pos, n = self.btrack.pop()
+        del self.caps[n:]
+        self.IP = L
+
+    @opcode(0x14)
+    def fail(self):
+        """backtrack to the top choice point."""
+        self._backtrack()
+
+    @opcode(0x15)
+    def fail_twice(self):
+        """drop the top choice point, then backtrack."""
+        self.btrack.pop()
+        self._backtrack()
+
+    @opcode(0x20, 'I')
+    def call(self, L):
+        """push the return address and jump to L."""
+        self.btrack.append(self.IP)
+        self.IP = L
+
+    @opcode(0x21)
+    def ret(self):
+        """jump to the return address on top of the backtrack stack."""
+        self.IP = self.btrack.pop()
+
+    @opcode(0x22, 'I')
+    def jump(self, L):
+        self.IP = L
+
+    @opcode(0x30, 'H')
+    def open(self, k):
+        """open a capture labelled with constant k."""
+        self.caps.append((k, self.pos))
+
+    @opcode(0x31)
+    def close(self):
+        """close the innermost open capture."""
+        self.caps.append((None, self.pos))
+
+    # superinstructions, for pairs which run often on the meta grammar
+    @opcode(0x40, 'II', fuses=('choice', 'char'))
+    def test_char(self, L, c):
+        """choice L then char c, without pushing a choice point when c doesn't match."""
+        if self.pos < len(self.src) and ord(self.src[self.pos]) == c:
+            self.btrack.append((L, self.pos, len(self.caps)))
+            self.pos += 1
+        else:
+            if self.pos > self.far:
+                self.far = self.pos
+            self.IP = L
+
+    @opcode(0x41, 'IH', fuses=('choice', 'set'))
+    def test_set(self, L, k):
+        """choice L then set k, without pushing a choice point when nothing matches."""
+        if self.pos < len(self.src) and self.src[self.pos] in self.consts[k]:
+            self.btrack.append((L, self.pos, len(self.caps)))
+            self.pos += 1
+        else:
+            if self.pos > self.far:
+                self.far = self.pos
+            self.IP = L
+
+    @opcode(0x44, 'IH', fuses=('choice', 'string'))
+    def test_string(self, L, k):
+        """choice L then string k, without pushing a choice point when it doesn't match."""
+        if self.src.startswith(self.consts[k], self.pos):
+            self.btrack.append((L, self.pos, len(self.caps)))
+            self.pos += len(self.consts[k])
+        else:
+            s = self.consts[k]
+            n = 0
+            while self.pos + n < len(self.src) and self.src[self.pos + n] == s[n]:
+                n += 1
+            if self.pos + n > self.far:
+                self.far = self.pos + n
+            self.IP = L
+
+    @opcode(0x42, 'HI', fuses=('open', 'call'))
+    def open_call(self, k, L):
+        """open k then call L."""
+        self.caps.append((k, self.pos))
+        self.btrack.append(self.IP)
+        self.IP = L
+
+    @opcode(0x43, 'HI', fuses=('set', 'partial_commit'))
+    def set_partial_commit(self, k, L):
+        """set k then partial_commit L, one iteration of a loop over a character set."""
+        if self.pos < len(self.src) and self.src[self.pos] in self.consts[k]:
+            self.pos += 1
+            self.btrack[-1] = (self.btrack[-1][0], self.pos, len(self.caps))
+            self.IP = L
+        else:
+            self._backtrack()
+
+
+def test_meta():
+    """this is proof of the fixed point grammar."""
+    defined = Grammar.meta()
+    src = defined.peg()
+    calc = Grammar.from_ast(PegVM().ast(src))
+    assert defined.peg() == calc.peg()
+
+
+def test_depth():
+    """deeply nested input doesn't recurse in python."""
+    from grammar import label, first, seq, lit
+    g = Grammar()
+    g['grammar'] = label('x', first(seq(lit('('), g['grammar'], lit(')')), lit('x')))
+    depth = 5000
+    m = PegVM(g).parse('(' * depth + 'x' + ')' * depth)
+    while m.content:
+        m = m.content[0]
+        depth -= 1
+    assert depth == -1
+
+
+def test_step():
+    """the predecoded loop and step() agree."""
+    vm = PegVM()
+    src = Grammar.meta().peg()
+    assert vm.parse(src) == vm.parse(src, debug=True)
+    for bad in ('ok <- .\nbogus <- 123', 'x <- (', ''):
+        errors = []
+        for debug in (False, True):
+            try:
+                errors.append(vm.parse(bad, debug).stop)
+            except ParseError as e:
+                errors.append((e.lineno, e.offset))
+        assert errors[0] == errors[1]
+
+
+def test_optimize():
+    """optimized and superinstruction code parse the same as the plain program."""
+    src = Grammar.meta().peg()
+    plain = PegVM(optimize=False)
+    vm = PegVM()
+    assert len(vm.code) < len(plain.code)
+    before = bytes(vm.code)
+    profile = vm.specialize([src])
+    assert vm.code != before and len(vm.code) < len(plain.code)
+    assert {p for p, _ in profile.most_common()} >= vm.fused.keys()
+    assert vm.parse(src) == plain.parse(src)
+    for bad in ('ok <- .\nbogus <- 123', 'x <- "ab" "c" "d', 'x <- (', ''):
+        errors = []
+        for P in (plain, vm):
+            try:
+                errors.append(P.parse(bad).stop)
+            except ParseError as e:
+                errors.append((e.lineno, e.offset))
+        assert errors[0] == errors[1]
+
+
+def test_regex():
+    """grammars with regex terms compile."""
+    src = Grammar.meta().peg()
+    g = Grammar.meta()
+    g.enable_regex()
+    vm = PegVM(g)
+    assert any(x[0] is vm.regex for x in vm._program if not isinstance(x, str))
+    assert list(vm.ast(src)) == list(PegVM().ast(src))
+
+
+def test_copy():
+    """removing left recursion doesn't rewrite the grammar given."""
+    from grammar import first, seq, lit
+    g = Grammar()
+    g['grammar'] = first(seq(g['grammar'], lit(' bap')), lit('boom'))
+    before = g.peg()
+    assert PegVM(g).parse('boom bap bap').stop == 12
+    assert g.peg() == before
+
+
+def test_failure():
+    try:
+        PegVM().parse('ok <- .\nbogus <- 123')
+        assert False, 'should not parse'
+    except ParseError as e:
+        assert (e.lineno, e.offset) == (2, 10)
+
+
+if __name__ == "__main__":
+    import pytest
+    pytest.main([__file__])
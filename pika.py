@@ -49,10 +49,14 @@ and translates very directly to a struct.
     * use tests to show equivalence
 """
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from enum import IntEnum
 import heapq
+import os
+import re
 
-from base import ParseError, Parser, match
+from base import ParseError, Parser, SourceMap, match
+from charset import CharSet
 from grammar import *
 
 # types for internal index format
@@ -60,6 +64,85 @@ from grammar import *
 type _memo = defaultdict[int, dict[int, match]]
 
 
+def _flatten(content: tuple[match, ...]) -> tuple[match, ...]:
+    """replace unlabelled matches with their (already flattened) content."""
+    out = []
+    for m in content:
+        if m.label:
+            out.append(m)
+        else:
+            out.extend(m.content)
+    return tuple(out)
+
+
+def _chunk_rows(P: 'Pika', text: str, start: int, stop: int, compact: bool, whole: bool) -> dict[int, dict[int, match]]:
+    """
+    fill the memo for text down to start, and return the rows in [start, stop)
+    which would be the same if text hadn't been truncated. whole means it wasn't.
+
+    A clause at sI is tainted if its match could differ given the rest of the text:
+    a terminal which reads past the end of text, a seq or loop which looks up a tainted clause
+    further right, or a clause seeded by a tainted clause in the same row.
+    The lookups are found again from the filled memo rather than recorded while filling,
+    since a seq or loop only looks at the stops of the matches of its earlier children.
+    A row is kept if nothing in it is tainted.
+    """
+    memo: _memo = defaultdict(dict)
+    for sI in reversed(range(start, len(text)+1)):
+        P._fill(text, sI, memo, compact)
+    if whole:
+        return {sI: memo[sI] for sI in range(start, stop)}
+
+    end = len(text)
+    # how far past sI each terminal reads, None if there's no telling (a regex)
+    bounds = {
+        cI: None if c[0] == T.re else len(P.metadata[cI]) if c[0] == T.lit else 1
+        for cI in P.live
+        if (c := P.index[cI])[0] in (T.lit, T.dot, T.char, T.ichar, T.re)
+    }
+    unbounded = [cI for cI, b in bounds.items() if b is None]
+    furthest = max((b for b in bounds.values() if b is not None), default=0)
+    walks = {cI: c for cI in P.live if (c := P.index[cI])[0] in (T.seq, T.zed, T.one)}
+
+    taint: dict[int, set[int]] = {}
+    rows = {}
+    for sI in reversed(range(start, end+1)):
+        row = memo[sI]
+        bad = list(unbounded)
+        if sI + furthest > end:
+            bad.extend(cI for cI, b in bounds.items() if b is not None and sI + b > end)
+        # only a seq or loop seeded by a non-empty match here can look further right
+        further = {p for cI, m in row.items() if m.stop > sI for p in P.seeds[cI] if p in walks}
+        for cI in further:
+            # follow the lookups the clause made, as in _match
+            c = walks[cI]
+            seq = c[0] == T.seq
+            i, pos = 1, sI
+            while (m := memo[pos].get(c[i])) is not None:
+                if m.stop == pos and not seq:
+                    break
+                pos = m.stop
+                if seq:
+                    i += 1
+                    if i == len(c):
+                        break
+                if pos > sI and c[i] in taint.get(pos, ()):
+                    bad.append(cI)
+                    break
+        if not bad:
+            if sI < stop:
+                rows[sI] = row
+            continue
+        tainted = set(bad)
+        while bad:
+            for cI in P.seeds[bad.pop()]:
+                if cI not in tainted:
+                    tainted.add(cI)
+                    bad.append(cI)
+        taint[sI] = tainted
+    return rows
+
+
 class Pika:
     def __init__(self, g: Grammar | str | None = None, startRule: str = 'grammar'):
         match g:
@@ -68,7 +151,7 @@ class Pika:
             case None:
                 g = Grammar.meta()
             case dict():
-                g = Grammar(g)  # copy
+                g = Grammar(g)
             case _:
                 raise ValueError(g)
 
@@ -87,99 +170,199 @@ class Pika:
         # a/(b/c) -> a/b/c
         # references can always be eliminated unless recursive. careful
 
+        self.startRule = startRule
+        # work on a copy, so the grammar given can be edited and passed to update()
+        self._pool = Pool()
+        self._source = g.freeze(self._pool)
+        self._load(self._source.thaw())
+
+    def update(self, g: Grammar) -> set[str]:
+        """
+        switch to grammar g, and return the names of the rules which changed.
+
+        Clauses of the changed rules and the rules which use them are appended to the index,
+        and the clauses they replace are retired by dropping them from alwaysRun and seeds.
+        Nothing is renumbered, so the rest of the index, seeds and metadata stay as they are.
+        Retired clauses are kept until they outnumber the live ones, then the index is built again.
+        """
+        source = Grammar(g).freeze(self._pool)
+        changed = self._source.diff(source)
+        if not changed:
+            return changed
+        self._source = source
+        if len(self.index) > 2 * len(self.live):
+            self._load(source.thaw())
+        else:
+            self._load(source.thaw(), frozenset(changed & g.keys()))
+        return changed
+
+    def _load(self, g: Grammar, dirty: frozenset[str] | None = None):
+        """
+        add the clauses of g to the index.
+
+        Clauses are also keyed by their structure, so if dirty is given,
+        a clause equal to one indexed before which doesn't use a dirty rule is reused.
+        Otherwise the index is built from scratch.
+        """
         g.deduplicate() # reduce identical subgraphs
+        g.inline(self.startRule) # fewer, wider clauses
         g.validate()
+        nodes: dict[int, int] = {}
+        reduced = g.freeze(self._pool, nodes)
+        if dirty is None:
+            self.index: tuple[tuple[T, *tuple[int, ...]], ...] = ()
+            self.clauses: tuple[term, ...] = ()
+            self.metadata = {}
+            self.alwaysRun: tuple[int, ...] = ()
+            self.seeds: tuple[tuple[int, ...], ...] = ()
+            self.live: frozenset[int] = frozenset()
+            self._cIs: dict[int, int] = {}  # structure -> cI
+            self._firsts: dict[str, int] = {}  # first character -> cI of its single character lit()
+            self._nullable: set[int] = set()
+            dirty = frozenset()
+        else:
+            dirty = g.analysis.dependents(dirty | (self._reduced.diff(reduced) & g.keys()))
+        self._reduced = reduced
         self.grammar = g
-        self.startRule = startRule
-
-        # this will be the set of ast nodes this parser can produce
-        labels = set()
 
         # §2.5
         # Walk all subclauses in the grammar which are reachable from the given starting rule using a depth-first search.
         # The purpose of this is to generate a topological sort of the grammar as a graph of clauses.
         # i.e. idx is a deduplicated post-order traversal of the graph.
         # While we're visiting each node, transform references to subclauses to integer indexes into idx.
-        idx: list[tuple[T, *tuple[int, ...]]] = []
-        metadata = {}
+        # New clauses are appended, so their children (old or new) still come first.
+        idx = list(self.index)
+        clauses = list(self.clauses)
+        fresh = len(clauses)
+        metadata = self.metadata
         seen = {}
         def getcI(n):
             return seen[id(n)]
 
-        for cI, n in enumerate(g.terms(startRule)):
-            seen[id(n)] = cI
-        for cI, n in enumerate(g.terms(startRule)):
+        # Multi-character literals are seeded by a virtual clause matching only their first character.
+        # basically this is a transform 'abc' -> &'a' 'abc'
+        # we do this so that lit() can be treated as a non-terminal in the multicharacter case,
+        # and startswith() is only called where the first character already matched.
+        # The virtual clauses are deduplicated by character, and shared with any real single character lit().
+        firsts = self._firsts
+        for n in g.terms(self.startRule):
+            node = nodes[id(n)]
+            cI = self._cIs.get(node)
+            if cI is not None and not (cI < fresh and self._pool.refs(node) & dirty):
+                seen[id(n)] = cI
+                continue
+            match n:
+                case [T.lit, s] if len(s) > 1 and s[0] not in firsts:
+                    firsts[s[0]] = len(clauses)
+                    clauses.append(lit(s[0]))
+                case [T.lit, s] if len(s) == 1:
+                    if s in firsts:
+                        seen[id(n)] = firsts[s]
+                        continue
+                    firsts[s] = len(clauses)
+            seen[id(n)] = self._cIs[node] = len(clauses)
+            clauses.append(n)
+        analysis = g.analysis
+        for cI in range(fresh, len(clauses)):
+            n = clauses[cI]
+            if id(n) in analysis.ids and analysis.nullable(n):
+                # virtual first character clauses aren't in the grammar, but are never nullable.
+                self._nullable.add(cI)
             match n:
                 case [T.ref, name]:
                     idx.append((T.ref, getcI(g[name])))
                 case [T.label, name, inner]:
-                    labels.add(name)
                     metadata[cI] = name
                     idx.append((T.label, getcI(inner)))
-                case [T.seq | T.first, left, right]:
-                    idx.append((n[0], getcI(left), getcI(right)))
+                case [T.seq | T.first, *terms]:
+                    idx.append((n[0], *map(getcI, terms)))
                 case [T.no | T.yes | T.zed | T.one | T.opt, inner]:
                     idx.append((n[0], getcI(inner)))
                 case [T.lit, inner]:
-                    # TODO insert virtual clauses as dependency for multichar lit()
-                    # basically this is a transform 'abc' -> &'a' 'abc'
-                    # we do this so that lit() can be treated as a non-terminal in the multicharacter case
                     metadata[cI] = inner
-                    idx.append((T.lit,))
+                    if len(inner) > 1:
+                        idx.append((T.lit, firsts[inner[0]]))
+                    else:
+                        idx.append((T.lit,))
                 case [T.dot]:
                     idx.append((T.dot,))
+                case [T.re, pattern]:
+                    metadata[cI] = re.compile(pattern)
+                    idx.append((T.re,))
                 case [ T.char | T.ichar , *spec]:
-                    # expand and deduplicate character set
-                    metadata[cI] = frozenset(
-                        chr(c)
-                        for s in spec
-                        for c in range(ord(s[0]), ord(s[-1]) + 1)
-                    )
+                    # normalize to sorted intervals, rather than one entry per character
+                    metadata[cI] = CharSet.from_spec(spec)
                     idx.append((n[0],))
                 case _:
                     raise ValueError(n)
+
+        # clauses which can't be reached from the goal any more are retired.
+        # they stay in the index, but nothing runs or seeds them.
+        self.goal = getcI(g[self.startRule])
+        live = set()
+        todo = [self.goal]
+        while todo:
+            cI = todo.pop()
+            if cI not in live:
+                live.add(cI)
+                todo.extend(idx[cI][1:])
+        added, retired = live - self.live, self.live - live
+
         # finalize
         self.index = tuple(idx)
-        self.labels = frozenset(labels)
-        self.metadata = metadata
-
-        memo: _memo = defaultdict(dict)
-        alwaysRun = []
-        nullable = set()
-        for cI, c in enumerate(self.index):
-            if (m := self._match('', 0, cI, memo)) is not None:
-                # determine which clauses to always run
-                # by matching them against an empty src string.
-                memo[0][cI] = m
-                alwaysRun.append(cI)
-                nullable.add(cI)
-            elif c[0] in (T.lit, T.char, T.dot):
+        self.clauses = tuple(clauses)
+        self.live = frozenset(live)
+        # this will be the set of ast nodes this parser can produce
+        self.labels = frozenset(metadata[cI] for cI in live if idx[cI][0] == T.label)
+
+        alwaysRun = set(self.alwaysRun) - retired
+        for cI in added:
+            c = self.index[cI]
+            if cI in self._nullable:
+                # clauses which can match without consuming input are always run,
+                # since no child match would seed them.
+                alwaysRun.add(cI)
+            elif c[0] in (T.lit, T.char, T.dot, T.re) and len(c) == 1:
                 # also include all terminal nodes
-                alwaysRun.append(cI)
-        heapq.heapify(alwaysRun)
-        self.alwaysRun = tuple(alwaysRun)
+                # multi-character lit() is seeded by its first character instead
+                alwaysRun.add(cI)
+        # a sorted list is already a heap
+        self.alwaysRun = tuple(sorted(alwaysRun))
 
         # §2.6
         # generate seed parent clauses
         # basically, if a clause matches, which
-        seeds = [[] for _ in range(len(self.index))]
-        for cI, c in enumerate(self.index):
-            match c[0]:
-                case T.seq:
-                    for child in c[1:]:
-                        seeds[child].append(cI)
-                        # if the child must consume input
-                        # its remaining siblings cannot seed
-                        # from this parent
-                        if child not in nullable:
-                            break
-
-                case T.first | T.no | T.yes | T.zed | T.one | T.opt | T.ref | T.label:
-                    for child in c[1:]:
-                        seeds[child].append(cI)
+        seeds = [list(s) for s in self.seeds]
+        seeds.extend([] for _ in range(len(self.seeds), len(self.index)))
+        for cI in retired:
+            for child in self._seeded_by(cI):
+                seeds[child].remove(cI)
+        for cI in added:
+            for child in self._seeded_by(cI):
+                seeds[child].append(cI)
         # finalize seeds
         self.seeds = tuple(tuple(s) for s in seeds)
 
+    @property
+    def kinds(self) -> set[str]:
+        return set(self.labels)
+
+    def _seeded_by(self, cI: int) -> tuple[int, ...]:
+        """the children of clause cI whose matches seed it."""
+        c = self.index[cI]
+        match c[0]:
+            case T.seq:
+                for i, child in enumerate(c[1:], 1):
+                    # if the child must consume input
+                    # its remaining siblings cannot seed
+                    # from this parent
+                    if child not in self._nullable:
+                        return c[1:i+1]
+                return c[1:]
+            case T.first | T.no | T.yes | T.zed | T.one | T.opt | T.ref | T.label | T.lit:
+                return c[1:]
+        return ()
+
     def _match(self, src: str, sI: int, cI: int, memo: _memo) -> match | None:
         c = self.index[cI]
         match c[0]:
@@ -195,6 +378,9 @@ class Pika:
                 s = self.metadata[cI]
                 if src.startswith(s, sI):
                     return match(sI, sI+len(s))
+            case T.re:
+                if (m := self.metadata[cI].match(src, sI)):
+                    return match(sI, m.end())
             case T.label:
                 if (m := memo[sI].get(c[1])):
                     return m._replace(label=self.metadata[cI])
@@ -236,10 +422,10 @@ class Pika:
             case _:
                 raise ValueError(f"{c=}")
 
-    def parse(self, text: str) -> match:
-        memo = self.get_memo(text)
+    def parse(self, text: str, compact: bool = False) -> match:
+        memo = self.get_memo(text, compact)
 
-        goal = memo[0].get(len(self.index)-1)
+        goal = memo[0].get(self.goal)
         if goal is None:
             # §3.2 error recovery
             # Syntax errors can be defined as regions of the input that are
@@ -291,25 +477,59 @@ class Pika:
             if stop is None:
                 stop = len(text)
 
-            def pos(idx):
-                lineno = 1 + text.count('\n', 0, idx)
-                offset = idx - text.rfind('\n', 0, idx)
-                return lineno, offset
-
-            startp = pos(start)
-            stopp = pos(stop)
-            raise ParseError(
-                f'parse failed from {startp} to {stopp}',
-                # file, lineno, offset, text, endlno, endoff
-                (None, *startp, text, *stopp)
-            )
+            src = SourceMap(text)
+            # file, lineno, offset, text, endlno, endoff
+            raise src.error(f'parse failed from {src.pos(start)} to {src.pos(stop)}', start, stop)
 
         return goal
 
     def ast(self, text: str):
         return self.parse(text).ast(text)
 
-    def get_memo(self, text: str) -> _memo:
+    def compact(self, memo: _memo) -> _memo:
+        """
+        drop every match which cannot contribute to the ast of the goal.
+
+        Only the goal and the labelled matches reachable from it are kept,
+        so the size of the result is proportional to the ast rather than
+        to the number of clauses times the length of the input.
+        """
+        goalI = self.goal
+        out: _memo = defaultdict(dict)
+        goal = memo[0].get(goalI)
+        if goal is None:
+            return out
+        out[0][goalI] = goal
+        # the label clauses for each label, usually just one
+        clauses: dict[str, list[int]] = defaultdict(list)
+        for cI in self.live:
+            if self.index[cI][0] == T.label:
+                clauses[self.metadata[cI]].append(cI)
+        stack = [goal]
+        while stack:
+            m = stack.pop()
+            for c in m.content:
+                stack.append(c)
+                if not c.label:
+                    continue
+                # matches don't know their clause, and the memo may hold equal copies
+                # (see get_memo_parallel), so find it by label and span rather than identity
+                row = memo.get(c.start, {})
+                cIs = [cI for cI in clauses[c.label] if (x := row.get(cI)) is not None and x.stop == c.stop]
+                if len(cIs) > 1:
+                    cIs = [cI for cI in cIs if row[cI] == c]
+                if cIs:
+                    out[c.start][cIs[0]] = c
+        return out
+
+    def get_memo(self, text: str, compact: bool = False) -> _memo:
+        """
+        fill the memo table for the given text.
+
+        If compact, unlabelled matches are flattened out of the content of
+        their parents as they are found, so that superseded matches are released
+        as soon as they are replaced, and the memo is compacted before returning.
+        """
         # TODO we could allocate this all at once
         #   almost every sI will have at least one match
         # memo:_memo = [{} for _ in range(len(text)+1)]
@@ -328,30 +548,71 @@ class Pika:
         #   this will automatically be overridden with longer match from seed if needed
 
         for sI in reversed(range(len(text)+1)):
-            # q is our priority queue. it is kept sorted with heapq
-            # self.alwaysRun was pre-heapified
-            q = list(self.alwaysRun)
-            while q:
-                cI = heapq.heappop(q)
-                # deduplicate work
-                # this will happen often, because a parent will be seeded by all of its subclauses
-                while q and q[0] == cI:
-                    heapq.heappop(q)
-                m = self._match(text, sI, cI, memo)
-                if m is None:
-                    continue
-                # §2.8 matches must be longer than previously found matches to be preferred.
-                # this checks the stop index only, since we know that the start index is the same
-                oldMatch = memo[sI].get(cI)
-                if oldMatch is not None and m.stop <= oldMatch.stop:
-                    continue
-                memo[sI][cI] = m
+            self._fill(text, sI, memo, compact)
 
-                # seed parent clauses
-                # seeds are mostly small, so don't bother with heapq.merge, it's very slow.
-                for c in self.seeds[cI]:
-                    heapq.heappush(q, c)
+        if compact:
+            return self.compact(memo)
+        return memo
 
+    def _fill(self, text: str, sI: int, memo: _memo, compact: bool = False):
+        """fill the row of the memo table at sI. Every row to the right must already be filled."""
+        # q is our priority queue. it is kept sorted with heapq
+        # self.alwaysRun was pre-heapified
+        q = list(self.alwaysRun)
+        while q:
+            cI = heapq.heappop(q)
+            # deduplicate work
+            # this will happen often, because a parent will be seeded by all of its subclauses
+            while q and q[0] == cI:
+                heapq.heappop(q)
+            m = self._match(text, sI, cI, memo)
+            if m is None:
+                continue
+            # §2.8 matches must be longer than previously found matches to be preferred.
+            # this checks the stop index only, since we know that the start index is the same
+            oldMatch = memo[sI].get(cI)
+            if oldMatch is not None and m.stop <= oldMatch.stop:
+                continue
+            if compact and m.content and self.index[cI][0] in (T.seq, T.zed, T.one):
+                # only these clauses build new content,
+                # everything else passes along an already flattened match.
+                m = m._replace(content=_flatten(m.content))
+            memo[sI][cI] = m
+
+            # seed parent clauses
+            # seeds are mostly small, so don't bother with heapq.merge, it's very slow.
+            for c in self.seeds[cI]:
+                heapq.heappush(q, c)
+
+    def get_memo_parallel(self, text: str, compact: bool = False, chunks: int | None = None, window: int = 256) -> _memo:
+        """
+        experimental: fill the memo table by splitting text into chunks which are parsed in worker processes.
+
+        Each row of the memo only depends on the rows to its right,
+        so each worker fills the rows of its chunk plus a window of the next chunk.
+        A row computed by a worker is kept only if nothing in it could have seen
+        the end of the text the worker was given (see _chunk_rows).
+        The rest are filled again sequentially from right to left, so the result equals get_memo(text).
+        """
+        chunks = chunks or os.cpu_count() or 1
+        bounds = [len(text) * i // chunks for i in range(chunks + 1)]
+        with ProcessPoolExecutor(chunks) as pool:
+            futures = [
+                pool.submit(_chunk_rows, self, text[:stop + window], start, stop, compact, stop + window >= len(text))
+                for start, stop in zip(bounds, bounds[1:])
+            ]
+            rows = {}
+            for f in futures:
+                rows.update(f.result())
+        memo: _memo = defaultdict(dict)
+        for sI in reversed(range(len(text)+1)):
+            if sI in rows:
+                memo[sI] = rows[sI]
+            else:
+                self._fill(text, sI, memo, compact)
+
+        if compact:
+            return self.compact(memo)
         return memo
 
     def chart(self, text: str, max_width=120, labels_only=False):
@@ -360,7 +621,7 @@ class Pika:
         memo = self.get_memo(text)
         text = text.replace('\n', '↩')
         lines = [f"{text}─╮"]
-        for cI, c in enumerate(self.grammar.terms(self.startRule)):
+        for cI, c in enumerate(self.clauses):
             if labels_only and c[0] != T.label:
                 continue
             line = []
@@ -381,7 +642,7 @@ class Pika:
         memo = self.get_memo(text)
         text = text.replace('\n', '↩')
         lines = [f"{text}─╮"]
-        for cI, c in enumerate(self.grammar.terms(self.startRule)):
+        for cI, c in enumerate(self.clauses):
             if c[0] != T.label:
                 continue
             spans = defaultdict(lambda: [False, False, False])
@@ -424,6 +685,75 @@ def test_meta():
     assert defined.peg() == calc.peg()
 
 
+def test_regex():
+    """collapsing terminals into regex doesn't change the ast."""
+    src = Grammar.meta().peg()
+    g = Grammar.meta()
+    g.enable_regex()
+    assert any(c[0] == T.re for c in Pika(g).index)
+    assert list(Pika(g).ast(src)) == list(Pika().ast(src))
+
+
+def test_compact():
+    src = Grammar.meta().peg()
+    P = Pika(Grammar.meta())
+    full = P.get_memo(src)
+    small = P.get_memo(src, compact=True)
+    assert list(P.parse(src).ast(src)) == list(P.parse(src, compact=True).ast(src))
+    assert sum(map(len, small.values())) < sum(map(len, full.values())) / 10
+    # only the goal and labelled matches survive
+    goal = small[0].pop(P.goal)
+    assert all(m.label for row in small.values() for m in row.values())
+    assert all(m.label for m in goal.content)
+
+
+def test_lit_seeding():
+    g = Grammar()
+    g['kw'] = label('kw', first(lit('if'), lit('in'), lit('else'), lit('i')))
+    g['grammar'] = seq(one(seq(g['kw'], zed(lit(' ')))), no(dot()))
+    P = Pika(g)
+    src = 'if in else i in'
+    assert [a[1] for a in P.ast(src)] == src.split()
+    # multi-character literals are seeded, not always run
+    assert not any(P.index[cI][0] == T.lit and len(P.metadata[cI]) > 1 for cI in P.alwaysRun)
+    # 'if' and 'in' share the virtual 'i', which is also the real 'i'
+    single = [cI for cI, c in enumerate(P.index) if c == (T.lit,) and P.metadata[cI] == 'i']
+    assert len(single) == 1
+    assert {P.metadata.get(cI) for cI in P.seeds[single[0]]} >= {'if', 'in'}
+
+
+def test_parallel():
+    src = Grammar.meta().peg()
+    P = Pika(Grammar.meta())
+    def rows(memo):
+        return {sI: row for sI, row in memo.items() if row}
+    assert rows(P.get_memo_parallel(src, chunks=4, window=32)) == rows(P.get_memo(src))
+    assert rows(P.get_memo_parallel(src, compact=True, chunks=4, window=32)) == rows(P.get_memo(src, compact=True))
+
+
+def test_update():
+    """changed rules are appended to the index, and the clauses they replace are retired."""
+    src = Grammar.meta().peg()
+    g = Grammar.meta()
+    P = Pika(g)
+    index = P.index
+    g['EOL'] = first(lit('\r\n'), lit('\n'), lit('\r'), lit(';'))
+    assert P.update(g) == {'EOL'}
+    assert P.index[:len(index)] == index and len(P.live) < len(P.index)
+    new = Pika(g)
+    assert P.labels == new.labels and len(P.live) == len(new.index)
+    retired = set(range(len(P.index))) - P.live
+    assert not retired & set(P.alwaysRun)
+    assert not any(retired & set(P.seeds[cI]) for cI in P.live)
+    for text in (src, src.replace('\n', ';')):
+        assert list(P.ast(text)) == list(new.ast(text))
+    for i in range(5):
+        g['EOL'] = first(lit('\n'), lit(str(i)))
+        P.update(g)
+        assert list(P.ast(src)) == list(Pika(g).ast(src))
+    assert len(P.index) <= 3 * len(P.live)
+
+
 def test_proto():
     pass # assert isinstance(Pika(), Parser)
 
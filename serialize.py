@@ -0,0 +1,379 @@
+"""
+streaming writers and readers for ast and match trees.
+
+Trees are written straight to a file object, node by node in preorder,
+with an explicit stack instead of recursion, and read back the same way,
+so neither side holds more than one tree and the path to the current node.
+
+formats
+* jsonl - one line per node, [*head, count] for a node with count children, "text" for a leaf value
+* sexp - one line per tree, (kind "text") or (kind child ...), strings quoted as in json
+* bin - varints, with each kind name written once and then referred to by number
+
+The head of an ast node is its kind, the head of a match is (label, start, stop).
+Every match is kept, labelled or not, so load_match(dump_match(m)) == m.
+"""
+import json
+import re
+from typing import IO, Callable, Iterable, Iterator
+
+from base import ast, match
+
+FORMATS = ('jsonl', 'sexp', 'bin')
+# binary streams start with this, the last byte is the version
+MAGIC = b'tr\x01'
+# bytes per read or write for the binary format
+_CHUNK = 1 << 16
+
+# a node is (head, count), a leaf value is a str
+type event = tuple[tuple, int] | str
+
+
+def dump_ast(trees: Iterable[ast], f: IO, fmt: str = 'jsonl'):
+    _dump(_ast_events(trees), f, fmt)
+
+
+def load_ast(f: IO, fmt: str = 'jsonl') -> Iterator[ast]:
+    return _load(f, fmt, 1, lambda head, args: (head[0], *args))
+
+
+def dump_match(matches: Iterable[match], f: IO, fmt: str = 'jsonl'):
+    _dump(_match_events(matches), f, fmt)
+
+
+def load_match(f: IO, fmt: str = 'jsonl') -> Iterator[match]:
+    return _load(f, fmt, 3, lambda head, args: match(head[1], head[2], head[0], tuple(args)))
+
+
+def _ast_events(trees: Iterable[ast]) -> Iterator[event]:
+    for a in trees:
+        stack = [a]
+        while stack:
+            x = stack.pop()
+            if isinstance(x, str):
+                yield x
+            else:
+                yield (x[0],), len(x) - 1
+                stack.extend(reversed(x[1:]))
+
+
+def _match_events(matches: Iterable[match]) -> Iterator[event]:
+    for m in matches:
+        stack = [m]
+        while stack:
+            x = stack.pop()
+            yield (x.label, x.start, x.stop), len(x.content)
+            stack.extend(reversed(x.content))
+
+
+def _dump(events: Iterator[event], f: IO, fmt: str):
+    match fmt:
+        case 'jsonl':
+            _dump_jsonl(events, f)
+        case 'sexp':
+            _dump_sexp(events, f)
+        case 'bin':
+            _dump_bin(events, f)
+        case _:
+            raise ValueError(f'unknown format {fmt!r}, expected one of {FORMATS}')
+
+
+def _load(f: IO, fmt: str, heads: int, make: Callable[[tuple, list], object]) -> Iterator:
+    match fmt:
+        case 'jsonl':
+            return _build(_load_jsonl(f), make)
+        case 'sexp':
+            return _load_sexp(f, heads, make)
+        case 'bin':
+            return _build(_load_bin(f, heads), make)
+        case _:
+            raise ValueError(f'unknown format {fmt!r}, expected one of {FORMATS}')
+
+
+def _build(events: Iterator[event], make: Callable[[tuple, list], object]) -> Iterator:
+    """fold counted preorder events back into trees."""
+    # [head, children left, children so far] for each open node
+    stack: list[list] = []
+    for e in events:
+        if isinstance(e, str):
+            x = e
+        else:
+            head, n = e
+            if n:
+                stack.append([head, n, []])
+                continue
+            x = make(head, [])
+        # x is complete, and may complete its ancestors
+        while stack:
+            top = stack[-1]
+            top[2].append(x)
+            top[1] -= 1
+            if top[1]:
+                break
+            stack.pop()
+            x = make(top[0], top[2])
+        else:
+            yield x
+    if stack:
+        raise ValueError('stream ended inside a tree')
+
+
+# jsonl
+def _dump_jsonl(events: Iterator[event], f: IO):
+    enc = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+    for e in events:
+        f.write(enc(e if isinstance(e, str) else [*e[0], e[1]]))
+        f.write('\n')
+
+
+def _load_jsonl(f: IO) -> Iterator[event]:
+    dec = json.JSONDecoder().decode
+    for line in f:
+        v = dec(line)
+        yield v if isinstance(v, str) else (tuple(v[:-1]), v[-1])
+
+
+# sexp
+_bare = re.compile(r'[^\s()"\d-][^\s()"]*')
+_token = re.compile(r'\s*(?:(\()|(\))|("(?:[^"\\]|\\.)*")|([^\s()"]+))')
+
+
+def _atom(x: str | int) -> str:
+    if isinstance(x, int):
+        return str(x)
+    return x if _bare.fullmatch(x) else json.dumps(x, ensure_ascii=False)
+
+
+def _dump_sexp(events: Iterator[event], f: IO):
+    # children still to come for each open node
+    left: list[int] = []
+    for e in events:
+        if left:
+            f.write(' ')
+        if isinstance(e, str):
+            f.write(json.dumps(e, ensure_ascii=False))
+        else:
+            head, n = e
+            f.write('(')
+            f.write(' '.join(map(_atom, head)))
+            if n:
+                left.append(n)
+                continue
+            f.write(')')
+        while left:
+            left[-1] -= 1
+            if left[-1]:
+                break
+            left.pop()
+            f.write(')')
+        else:
+            f.write('\n')
+
+
+def _load_sexp(f: IO, heads: int, make: Callable[[tuple, list], object]) -> Iterator:
+    # [head atoms, children] for each open node
+    stack: list[tuple[list, list]] = []
+    loads = json.JSONDecoder().decode
+    for line in f:
+        # strings are quoted as in json, so they never span lines
+        pos = 0
+        while (m := _token.match(line, pos)) and m.end() > pos:
+            pos = m.end()
+            opening, closing, string, bare = m.groups()
+            if opening:
+                stack.append(([], []))
+                continue
+            if not stack:
+                raise ValueError(f'value outside of a tree: {m.group().strip()!r}')
+            head, args = stack[-1]
+            if closing:
+                if len(head) != heads:
+                    raise ValueError(f'expected {heads} head atoms, got {head!r}')
+                stack.pop()
+                x = make(tuple(head), args)
+                if stack:
+                    stack[-1][1].append(x)
+                else:
+                    yield x
+                continue
+            x = loads(string) if string else int(bare) if bare.lstrip('-').isdigit() else bare
+            (head if len(head) < heads else args).append(x)
+        if line[pos:].strip():
+            raise ValueError(f'bad token at {line[pos:pos + 20]!r}')
+    if stack:
+        raise ValueError('stream ended inside a tree')
+
+
+# bin, and the helpers other binary formats share (see grammar.Frozen.to_bytes)
+def varint(buf: bytearray, n: int):
+    """append n as an unsigned LEB128 varint."""
+    while n > 0x7f:
+        buf.append(n & 0x7f | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+def read_varint(data: bytes, pos: int) -> tuple[int, int]:
+    """the varint at data[pos], and the position after it."""
+    n = shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError('data ended inside a value')
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7f) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def check_magic(head: bytes, magic: bytes, what: str):
+    """raise ValueError unless head is magic, where the last byte of magic is the version."""
+    if head[:-1] != magic[:-1]:
+        raise ValueError(f'not a {what}')
+    if head != magic:
+        raise ValueError(f'unsupported {what} version {head[-1:].hex() or "(missing)"}')
+
+
+def _dump_bin(events: Iterator[event], f: IO):
+    """
+    a node is varint(count << 1) then its head, a leaf is varint(len << 1 | 1) then utf-8.
+    ints in the head are varints, strs are the varint id of a name,
+    where the next unused id is followed by the length of the name and its utf-8.
+    """
+    names: dict[str, int] = {}
+    buf = bytearray(MAGIC)
+    for e in events:
+        if isinstance(e, str):
+            b = e.encode()
+            varint(buf, len(b) << 1 | 1)
+            buf += b
+        else:
+            head, n = e
+            varint(buf, n << 1)
+            for x in head:
+                if isinstance(x, int):
+                    varint(buf, x)
+                elif (k := names.get(x)) is not None:
+                    varint(buf, k)
+                else:
+                    varint(buf, names.setdefault(x, len(names)))
+                    b = x.encode()
+                    varint(buf, len(b))
+                    buf += b
+        if len(buf) >= _CHUNK:
+            f.write(buf)
+            buf.clear()
+    f.write(buf)
+
+
+class _Bytes:
+    """buffered reads from a binary file, a chunk at a time."""
+    def __init__(self, f: IO):
+        self.f = f
+        self.buf = b''
+        self.pos = 0
+
+    def more(self) -> bool:
+        if self.pos < len(self.buf):
+            return True
+        self.buf = self.f.read(_CHUNK)
+        self.pos = 0
+        return bool(self.buf)
+
+    def varint(self) -> int:
+        n = shift = 0
+        while True:
+            if not self.more():
+                raise ValueError('stream ended inside a value')
+            b = self.buf[self.pos]
+            self.pos += 1
+            n |= (b & 0x7f) << shift
+            if b < 0x80:
+                return n
+            shift += 7
+
+    def read(self, n: int) -> bytes:
+        out = self.buf[self.pos:self.pos + n]
+        self.pos += len(out)
+        while len(out) < n:
+            if not self.more():
+                raise ValueError('stream ended inside a value')
+            part = self.buf[self.pos:self.pos + n - len(out)]
+            self.pos += len(part)
+            out += part
+        return out
+
+
+def _load_bin(f: IO, heads: int) -> Iterator[event]:
+    r = _Bytes(f)
+    check_magic(r.read(len(MAGIC)), MAGIC, 'binary tree stream')
+    names: list[str] = []
+    while r.more():
+        n = r.varint()
+        if n & 1:
+            yield r.read(n >> 1).decode()
+            continue
+        # a name, then heads - 1 ints
+        k = r.varint()
+        if k == len(names):
+            names.append(r.read(r.varint()).decode())
+        yield (names[k], *(r.varint() for _ in range(heads - 1))), n >> 1
+
+
+def test_ast():
+    import io
+    from grammar import Grammar
+    from packrat import Packrat
+    src = Grammar.meta().peg()
+    trees = list(Packrat().ast(src))
+    # a value that needs quoting in every format
+    trees.append(('we "ird"', ('x', 'a\nb)\\ ('), ('-1', 'ünï')))
+    for fmt in FORMATS:
+        f = io.BytesIO() if fmt == 'bin' else io.StringIO()
+        dump_ast(trees, f, fmt)
+        f.seek(0)
+        assert list(load_ast(f, fmt)) == trees, fmt
+
+
+def test_match():
+    import io
+    from grammar import Grammar
+    from packrat import Packrat
+    src = Grammar.meta().peg()
+    m = Packrat().parse(src)
+    for fmt in FORMATS:
+        f = io.BytesIO() if fmt == 'bin' else io.StringIO()
+        dump_match([m, m], f, fmt)
+        f.seek(0)
+        assert list(load_match(f, fmt)) == [m, m], fmt
+
+
+def test_streaming():
+    """deep trees don't recurse, and binary reads may stop anywhere."""
+    import io
+
+    class Trickle(io.BytesIO):
+        def read(self, n=-1):
+            return super().read(1)
+
+    a = ('x', 'leaf')
+    for _ in range(5000):
+        a = ('x', a)
+    for fmt in FORMATS:
+        f = io.BytesIO() if fmt == 'bin' else io.StringIO()
+        dump_ast([a], f, fmt)
+        f = Trickle(f.getvalue()) if fmt == 'bin' else io.StringIO(f.getvalue())
+        # == on tuples this deep would recurse
+        assert list(_ast_events(load_ast(f, fmt))) == list(_ast_events([a])), fmt
+    f = io.StringIO('["x",2]\n"y"\n')
+    try:
+        list(load_ast(f))
+        assert False, 'should not load'
+    except ValueError:
+        pass
+
+
+if __name__ == "__main__":
+    import pytest
+    pytest.main([__file__])